@@ -0,0 +1,48 @@
+import argparse
+import json
+import logging
+
+from benchmarks.common import environment
+from trackstormsbot.autotune import CACHE_PATH, REFERENCES, ProfileCache, autotune, sample_frames
+
+
+def main():
+    parser = argparse.ArgumentParser('Detector autotuner')
+    parser.add_argument('-d',
+                        '--detectors',
+                        type=str,
+                        nargs='+',
+                        default=list(REFERENCES.keys()),
+                        choices=REFERENCES.keys(),
+                        help='Detectors to tune, one after the other')
+    parser.add_argument('--source',
+                        type=str,
+                        default=None,
+                        help='Video file or image directory (default: simulated faces)')
+    parser.add_argument('--size', type=int, nargs=2, default=[640, 480], help='Camera frame size to tune at')
+    parser.add_argument('--frames', type=int, default=12, help='Sample frames')
+    parser.add_argument('--min_agreement', type=float, default=0.9, help='Min agreement with the reference detections')
+    parser.add_argument('--cache', type=str, default=CACHE_PATH, help='Store the winning profiles for run.py')
+    parser.add_argument('--no_save', action='store_true', help='Only report, leave the cache file alone')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    frames = sample_frames(args.source, tuple(args.size), args.frames)
+    cache = ProfileCache(args.cache)
+    results = {'source': args.source, 'environment': environment(), 'profile_key': cache.key(), 'runs': {}}
+    for name in args.detectors:
+        profile = autotune(name, frames, min_agreement=args.min_agreement)
+        if not args.no_save:
+            cache.save(name, profile)
+        results['runs'][name] = profile
+
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
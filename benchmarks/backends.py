@@ -0,0 +1,84 @@
+import argparse
+import json
+import resource
+import time
+
+from benchmarks.common import BENCHMARK_MAP
+from trackstormsbot.backends import BACKENDS, get_backend_detector
+from trackstormsbot.camera import CameraStream
+from trackstormsbot.sources import SyntheticSource
+
+
+def cpu_time(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def workers_cpu(detectors):
+    # Thread backend detectors run in this process and are already part of its own usage
+    return sum(detector.worker_cpu() for detector in detectors.values() if hasattr(detector, 'worker_cpu'))
+
+
+def run_backend(backend, detector_names, duration, camera_rate):
+    camera = CameraStream(SyntheticSource(fps=camera_rate))
+    detectors = {
+        name: get_backend_detector(backend, BENCHMARK_MAP[name], camera, camera_rate)
+        for name in detector_names}
+
+    camera.open()
+    for detector in detectors.values():
+        detector.start()
+
+    # Measure once all workers are up and warm, so model loading is not counted
+    time.sleep(1.0)
+    processed_start = {name: detector.processed_frames() for name, detector in detectors.items()}
+    # Workers report their own CPU time with every result, only the part used inside the window is counted.
+    # Children usage would also include spawning the workers and loading the models
+    self_start, workers_start = cpu_time(resource.RUSAGE_SELF), workers_cpu(detectors)
+    start_time = time.perf_counter()
+    time.sleep(duration)
+    elapsed = time.perf_counter() - start_time
+    self_cpu = cpu_time(resource.RUSAGE_SELF) - self_start
+    worker_cpu = workers_cpu(detectors) - workers_start
+    processed = {name: detector.processed_frames() - processed_start[name] for name, detector in detectors.items()}
+    throughput = {name: count / elapsed for name, count in processed.items()}
+
+    ipc_time = {name: detector.ipc_time() for name, detector in detectors.items() if hasattr(detector, 'ipc_time')}
+    preprocess_time = {name: detector.preprocess_time() for name, detector in detectors.items()}
+
+    for detector in detectors.values():
+        detector.stop()
+    camera.close()
+    for detector in detectors.values():
+        detector.join()
+
+    return {
+        'backend': backend,
+        'throughput_fps': throughput,
+        'preprocess_ms': preprocess_time,
+        'ipc_overhead_ms': ipc_time,
+        'cpu_main_s': self_cpu,
+        'cpu_workers_s': worker_cpu,
+        'cores_busy': (self_cpu + worker_cpu) / elapsed,}
+
+
+def main():
+    parser = argparse.ArgumentParser('Detector backend overhead benchmark')
+    parser.add_argument('-d',
+                        '--detectors',
+                        type=str,
+                        nargs='+',
+                        default=['yunet', 'gesture'],
+                        choices=BENCHMARK_MAP.keys(),
+                        help='Detectors to run concurrently')
+    parser.add_argument('--backends', type=str, nargs='+', default=BACKENDS, choices=BACKENDS)
+    parser.add_argument('--duration', type=float, default=10.0, help='Measurement time per backend (s)')
+    parser.add_argument('--camera_rate', type=int, default=60, help='Rate of published frames (FPS)')
+    args = parser.parse_args()
+
+    results = [run_backend(backend, args.detectors, args.duration, args.camera_rate) for backend in args.backends]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
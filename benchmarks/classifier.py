@@ -0,0 +1,67 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from benchmarks.common import environment
+from trackstormsbot.gesture_recognisers import KeyPointClassifier, MediapipeRecogniser
+
+
+def legacy_call(classifier, landmark_list):
+    # The invocation as it was before the input buffer was pre-allocated, kept as the baseline
+    input_details_tensor_index = classifier.input_details[0]['index']
+    landmark_list = np.concatenate(([0, 0], landmark_list))
+    classifier.interpreter.set_tensor(input_details_tensor_index, np.array([landmark_list], dtype=np.float32))
+    classifier.interpreter.invoke()
+    result = classifier.interpreter.get_tensor(classifier.output_details[0]['index'])
+    return np.argmax(np.squeeze(result))
+
+
+def time_calls(function, iterations, warmup=100):
+    for _ in range(warmup):
+        function()
+    timings = np.empty(iterations)
+    for index in range(iterations):
+        start = time.perf_counter()
+        function()
+        timings[index] = time.perf_counter() - start
+    timings *= 1e6
+    return {
+        'mean_us': float(timings.mean()),
+        'p50_us': float(np.percentile(timings, 50)),
+        'p99_us': float(np.percentile(timings, 99)),}
+
+
+def main():
+    parser = argparse.ArgumentParser('Gesture classifier invocation benchmark')
+    parser.add_argument('--hands', type=int, default=2, help='Number of hands classified per frame')
+    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=10000)
+    parser.add_argument('-o', '--output', type=str, default=None, help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    landmarks = np.random.default_rng(0).uniform(-1, 1, (args.hands, 40)).astype(np.float32)
+
+    legacy = KeyPointClassifier(MediapipeRecogniser.KEYPOINT_CLASSIFIER_PATH, num_threads=args.num_threads)
+    classifier = KeyPointClassifier(MediapipeRecogniser.KEYPOINT_CLASSIFIER_PATH,
+                                    num_threads=args.num_threads,
+                                    max_batch_size=args.hands)
+
+    results = {
+        'environment': environment(),
+        'hands': args.hands,
+        'num_threads': args.num_threads,
+        # One invocation per hand, as the recogniser used to do
+        'legacy_per_hand': time_calls(lambda: [legacy_call(legacy, hand) for hand in landmarks], args.iterations),
+        'batched': time_calls(lambda: classifier.classify(landmarks), args.iterations),}
+
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
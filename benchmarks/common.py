@@ -0,0 +1,61 @@
+import os
+import subprocess
+
+import cv2
+
+from trackstormsbot.camera import FrameBus
+from trackstormsbot.detectors import DETECTOR_MAP
+from trackstormsbot.gesture_recognisers import MediapipeRecogniser
+from trackstormsbot.preprocess import PreprocessCache
+from trackstormsbot.recorder import SessionReader, is_session
+from trackstormsbot.sources import FileSource
+
+BENCHMARK_MAP = dict(DETECTOR_MAP, gesture=MediapipeRecogniser)
+
+
+class ReplayCamera:
+    # Camera stand-in for a video file or image directory, frames are published one by one by the caller
+
+    def __init__(self, path, size=(640, 480)):
+        # A recorded session replays its video, the rest of the recording is available through session()
+        self._session = SessionReader(path) if is_session(path) else None
+        if self._session is not None:
+            path, size = self._session.video_path(), self._session.frame_size()
+            if path is None:
+                raise ValueError('The session was recorded without video')
+        self._source = FileSource(path, size, loop=False, realtime=False)
+        self._source.open()
+        self._bus = FrameBus()
+        self._cache = PreprocessCache()
+
+    def frames(self):
+        return self._source.frames()
+
+    def session(self):
+        return self._session
+
+    def publish(self, image, timestamp=None):
+        return self._bus.publish(image, timestamp)
+
+    def subscribe(self):
+        return self._bus.subscribe()
+
+    def cache(self):
+        return self._cache
+
+    def size(self):
+        return self._source.size()
+
+    def fps(self):
+        return self._source.fps()
+
+    def is_opened(self):
+        return True
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'opencv': cv2.__version__, 'cpu_count': os.cpu_count()}
@@ -0,0 +1,233 @@
+import argparse
+import functools
+import json
+from collections import deque
+
+import numpy as np
+
+from benchmarks.common import environment
+from trackstormsbot.controller import CONTROLLER_MAP, PIDMotorController
+from trackstormsbot.recorder import FACES, PWM, SessionReader
+from trackstormsbot.simulation import SimulatedMotor, SimulatedPanTilt
+from trackstormsbot.targets import TargetSelector
+from trackstormsbot.utils import calculate_middle_xywh
+
+
+class VirtualClock:
+
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+def target_path(scenario, step, speed):
+    # Target position in degrees over time
+    if scenario == 'step':
+        return lambda t: np.array(step, dtype=np.float64)
+    if scenario == 'ramp':
+        return lambda t: np.array(step, dtype=np.float64) + np.array(speed) * t
+    if scenario == 'sine':
+        return lambda t: np.array(step, dtype=np.float64) * np.sin(2 * np.pi * t / 4)
+    raise ValueError(f'Unknown scenario {scenario}')
+
+
+def make_controller(name, clock, pixels_per_degree=(10, 10), feedback=True):
+    # Driving simulated motors on the virtual clock
+    motor_class = functools.partial(SimulatedMotor, clock=clock)
+    kwargs = {'motor_class': motor_class}
+    if CONTROLLER_MAP[name] is PIDMotorController:
+        kwargs.update(clock=clock, pixels_per_degree=pixels_per_degree if feedback else None)
+    return CONTROLLER_MAP[name](['A', 'B'], **kwargs)
+
+
+def run_controller(name,
+                   scenario='step',
+                   step=(20, 5),
+                   speed=(10, 0),
+                   frame_size=(640, 480),
+                   pixels_per_degree=(10, 10),
+                   control_rate=30,
+                   detector_rate=15,
+                   latency=0.1,
+                   duration=5.0,
+                   tolerance=0.05,
+                   feedback=True):
+    clock = VirtualClock()
+    controller = make_controller(name, clock, pixels_per_degree, feedback)
+    plant = SimulatedPanTilt(*controller.motors(), frame_size=frame_size, pixels_per_degree=pixels_per_degree)
+
+    path = target_path(scenario, step, speed)
+    frame_middle = (frame_size[0] // 2, frame_size[1] // 2)
+    half_frame = np.array(frame_middle, dtype=np.float64)
+
+    # Detections become available latency seconds after the frame they were made on was captured
+    pending = deque()
+    detection = None
+    next_capture = 0
+    errors = []
+    times = []
+    for index in range(int(duration * control_rate)):
+        clock.time = index / control_rate
+        while next_capture <= clock.time:
+            pending.append((next_capture + latency, plant.project(path(next_capture)), next_capture))
+            next_capture += 1 / detector_rate
+        while pending and pending[0][0] <= clock.time:
+            _, detection_middle, timestamp = pending.popleft()
+            detection = (tuple(int(v) for v in detection_middle), timestamp)
+
+        if detection is not None and np.all(np.abs(np.array(detection[0]) - half_frame) <= half_frame):
+            controller.move_to_middle(frame_middle, detection[0], 0.05, timestamp=detection[1])
+        else:
+            controller.stop()
+
+        # Scored on where the target really is, not on the delayed detection
+        errors.append((plant.project(path(clock.time)) - half_frame) / half_frame)
+        times.append(clock.time)
+
+    errors = np.array(errors)
+    times = np.array(times)
+    distance = np.abs(errors).max(axis=1)
+    outside = np.nonzero(distance > tolerance)[0]
+    settled = len(outside) == 0 or outside[-1] < len(times) - 1
+    settle_time = None if not settled else (0.0 if len(outside) == 0 else float(times[outside[-1] + 1]))
+
+    # Overshoot as the largest excursion past the middle, relative to the initial offset
+    initial = errors[0]
+    past_middle = (-np.sign(initial) * errors).max(axis=0).clip(min=0)
+    overshoot = [
+        float(past_middle[axis] / abs(initial[axis]) * 100) if abs(initial[axis]) > tolerance else 0.0
+        for axis in range(2)]
+
+    tail = errors[times >= duration / 2]
+    return {
+        'controller': name,
+        'scenario': scenario,
+        'feedback': feedback,
+        'settle_time_s': settle_time,
+        'overshoot_percent': overshoot,
+        'steady_state_rms': float(np.sqrt((tail ** 2).sum(axis=1).mean())),
+        'max_error': float(distance.max()),}
+
+
+def replay_controller(name, session, pixels_per_degree=(10, 10), control_rate=30, feedback=True, max_result_age=0.5):
+    # Face detections of a recorded session handed to the controller when they became available during the session,
+    # on virtual time so every replay gives the same commands. The camera does not follow the replayed motors,
+    # so this compares what the controller would have commanded with what was recorded, it is not closed loop
+    faces = [(timestamp + delay, detections) for _, _, timestamp, delay, detections in session.records({FACES})]
+    recorded_pwm = [(timestamp + delay, pwm) for _, _, timestamp, delay, pwm in session.records({PWM})]
+    if not faces:
+        raise ValueError('The session has no face detections')
+
+    clock = VirtualClock()
+    start_time, end_time = faces[0][0], faces[-1][0]
+    clock.time = start_time
+    controller = make_controller(name, clock, pixels_per_degree, feedback)
+    frame_size = session.frame_size()
+    frame_middle = (frame_size[0] // 2, frame_size[1] // 2)
+
+    targets = TargetSelector()
+    replayed = []
+    recorded = []
+    face_index = pwm_index = 0
+    detections = None
+    target = None
+    stale_steps = 0
+    pwm = (0, 0)
+    for index in range(int((end_time - start_time) * control_rate) + 1):
+        clock.time = start_time + index / control_rate
+        while face_index < len(faces) and faces[face_index][0] <= clock.time:
+            detections = faces[face_index][1]
+            target = targets.update(detections)
+            face_index += 1
+        while pwm_index < len(recorded_pwm) and recorded_pwm[pwm_index][0] <= clock.time:
+            pwm = recorded_pwm[pwm_index][1]
+            pwm_index += 1
+
+        # The same decisions as the control loop of the service
+        stale = detections is not None and clock.time - detections.timestamp > max_result_age
+        stale_steps += stale
+        if target is None or stale:
+            controller.stop()
+        else:
+            box = detections.box(target)
+            controller.move_to_middle(frame_middle,
+                                      calculate_middle_xywh(box),
+                                      box[2] * box[3] / (frame_size[0] * frame_size[1]),
+                                      timestamp=detections.timestamp)
+        replayed.append(controller.pwm())
+        recorded.append(pwm)
+
+    replayed = np.array(replayed, dtype=np.float64)
+    recorded = np.array(recorded, dtype=np.float64)
+    return {
+        'controller': name,
+        'scenario': 'replay',
+        'feedback': feedback,
+        'duration_s': end_time - start_time,
+        'detections': len(faces),
+        'target_switches': targets.switches(),
+        'stale_steps': stale_steps,
+        'pwm_rms_difference': np.sqrt(((replayed - recorded) ** 2).mean(axis=0)).tolist(),
+        'replayed_pwm_mean_abs': np.abs(replayed).mean(axis=0).tolist(),
+        'recorded_pwm_mean_abs': np.abs(recorded).mean(axis=0).tolist(),}
+
+
+def main():
+    parser = argparse.ArgumentParser('Simulated motor control benchmark')
+    parser.add_argument('-c',
+                        '--controllers',
+                        type=str,
+                        nargs='+',
+                        default=list(CONTROLLER_MAP.keys()),
+                        choices=CONTROLLER_MAP.keys())
+    parser.add_argument('--scenario', type=str, default='step', choices=['step', 'ramp', 'sine'])
+    parser.add_argument('--recording',
+                        type=str,
+                        default=None,
+                        help='Replay the detections of a recorded session instead of a scenario')
+    parser.add_argument('--step', type=float, nargs=2, default=[20, 5], help='Initial target offset (degrees)')
+    parser.add_argument('--speed', type=float, nargs=2, default=[10, 0], help='Target speed for ramp (degrees/s)')
+    parser.add_argument('--control_rate', type=int, default=30)
+    parser.add_argument('--detector_rate', type=int, default=15)
+    parser.add_argument('--latency', type=float, default=0.1, help='Capture to detection latency (s)')
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--max_result_age',
+                        type=float,
+                        default=0.5,
+                        help='Replayed detections older than this (s) are not steered on')
+    parser.add_argument('--no_feedback', action='store_true', help='Run the PID controller without position feedback')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    results = {'environment': environment(), 'runs': []}
+    for name in args.controllers:
+        if args.recording is not None:
+            results['runs'].append(
+                replay_controller(name,
+                                  SessionReader(args.recording),
+                                  control_rate=args.control_rate,
+                                  feedback=not args.no_feedback,
+                                  max_result_age=args.max_result_age))
+            continue
+        results['runs'].append(
+            run_controller(name,
+                           scenario=args.scenario,
+                           step=args.step,
+                           speed=args.speed,
+                           control_rate=args.control_rate,
+                           detector_rate=args.detector_rate,
+                           latency=args.latency,
+                           duration=args.duration,
+                           feedback=not args.no_feedback))
+
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import json
+import resource
+import time
+from collections import Counter
+
+import numpy as np
+
+from benchmarks.common import BENCHMARK_MAP, ReplayCamera, environment
+from trackstormsbot.autotune import agreement
+from trackstormsbot.detectors import DETECTOR_MAP
+from trackstormsbot.recorder import FACES, FRAME
+
+
+def run_detector(name, camera, det_frame_size=None, realtime=False, max_frames=None):
+    kwargs = {} if det_frame_size is None else {'det_frame_size': tuple(det_frame_size)}
+    detector = BENCHMARK_MAP[name](camera, -1, **kwargs)
+
+    latencies = []
+    detection_counts = []
+    labels = Counter()
+
+    # Faces found in a recorded session, to compare with what the detector finds on the same frames now
+    session = camera.session()
+    recorded_faces = {}
+    frame_seqs = []
+    if session is not None and name in DETECTOR_MAP:
+        recorded_faces = {seq: faces for _, seq, _, _, faces in session.records({FACES})}
+        frame_seqs = [seq for _, seq, _, _, _ in session.records({FRAME})]
+    found_boxes = []
+    recorded_boxes = []
+    memory_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.perf_counter()
+
+    # Frames are fed synchronously, so every frame is processed exactly once
+    for index, image in enumerate(camera.frames()):
+        if max_frames is not None and index >= max_frames:
+            break
+        if realtime:
+            delay = start_time + index / camera.fps() - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        frame = camera.publish(image)
+        frame_start = time.perf_counter()
+        detections, frame_labels = detector.process(detector.preprocess(frame))
+        detections = detector.update_roi(detections)
+        latencies.append(time.perf_counter() - frame_start)
+
+        detection_counts.append(len(detections))
+        if index < len(frame_seqs) and frame_seqs[index] in recorded_faces:
+            found_boxes.append(detections.boxes)
+            recorded_boxes.append(recorded_faces[frame_seqs[index]].boxes)
+        if isinstance(frame_labels, str):
+            labels[frame_labels] += 1
+
+    elapsed = time.perf_counter() - start_time
+    latencies = np.array(latencies) * 1000
+    detection_counts = np.array(detection_counts)
+    if len(latencies) == 0:
+        raise ValueError('No frames could be read from the source')
+
+    return {
+        'detector': name,
+        'det_frame_size': list(detector.det_frame_size()),
+        'frames': len(latencies),
+        'realtime': realtime,
+        'throughput_fps': len(latencies) / elapsed,
+        'latency_ms': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),},
+        # ru_maxrss is in kilobytes on Linux
+        'memory_peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'memory_growth_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory_start) / 1024,
+        'detections': {
+            'frames_with_detections': int((detection_counts > 0).sum()),
+            'total': int(detection_counts.sum()),
+            'mean_per_frame': float(detection_counts.mean()),},
+        'labels': dict(labels),
+        'recorded_agreement': agreement(found_boxes, recorded_boxes) if recorded_boxes else None,}
+
+
+def main():
+    parser = argparse.ArgumentParser('Offline detector benchmark')
+    parser.add_argument('source', type=str, help='Video file, directory of images or recorded session')
+    parser.add_argument('-d',
+                        '--detectors',
+                        type=str,
+                        nargs='+',
+                        default=['yunet'],
+                        choices=BENCHMARK_MAP.keys(),
+                        help='Detectors to benchmark, one after the other')
+    parser.add_argument('--det_frame_size', type=int, nargs=2, default=None, help='Override detection frame size')
+    parser.add_argument('--size', type=int, nargs=2, default=[640, 480], help='Camera frame size to replay at')
+    parser.add_argument('--realtime', action='store_true', help='Pace frames at the source frame rate')
+    parser.add_argument('--max_frames', type=int, default=None)
+    parser.add_argument('-o', '--output', type=str, default=None, help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    results = {'source': args.source, 'environment': environment(), 'runs': []}
+    for name in args.detectors:
+        camera = ReplayCamera(args.source, size=tuple(args.size))
+        results['runs'].append(run_detector(name, camera, args.det_frame_size, args.realtime, args.max_frames))
+
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,125 +1,454 @@
+import time
+
+# Startup is timed from here, so the imports are part of the breakdown
+START_TIME = time.perf_counter()
+
 import argparse
+import json
 import logging
+import os
 
-import cv2
-from flask import Flask, Response, render_template
+from flask import Flask, Response, abort, jsonify, render_template
 
+from trackstormsbot.autotune import CACHE_PATH, REFERENCES, ProfileCache, autotune, sample_frames
+from trackstormsbot.backends import BACKENDS, get_backend_detector
 from trackstormsbot.camera import CameraStream
-from trackstormsbot.controller import DistanceSensorController, MotorController
-from trackstormsbot.detectors import *
-from trackstormsbot.gesture_recognisers import *
-from trackstormsbot.utils import *
+from trackstormsbot.controller import CONTROLLER_MAP, DistanceSensorController, PIDMotorController
+from trackstormsbot.detectors import DETECTOR_MAP
+from trackstormsbot.gesture_recognisers import MediapipeRecogniser
+from trackstormsbot.hat import BuildHatWorker
+from trackstormsbot.metrics import REGISTRY, StartupTimer
+from trackstormsbot.perception import FusedPerception
+from trackstormsbot.pool import ModelPool
+from trackstormsbot.recorder import SessionRecorder
+from trackstormsbot.scheduler import DetectorScheduler
+from trackstormsbot.service import TrackingService
+from trackstormsbot.simulation import SimulatedRig
+from trackstormsbot.sources import SOURCES, VideoCaptureSource, get_source
+from trackstormsbot.streaming import StreamEncoder, mjpeg_stream, sse_stream
+from trackstormsbot.trackers import TRACKER_MAP, TrackedDetector
 
 log = logging.getLogger(__name__)
 
 app = Flask(__name__, template_folder='trackstormsbot/templates')
 
-DETECTOR_MAP = {
-    'haarcascade': CascadeDetector,
-    'yunet': YuNetDetector,
-    'mediapipe': MediapipeDetector,}
+services = {}
+
+SERVERS = ['werkzeug', 'waitress']
 
 
 def get_args():
     parser = argparse.ArgumentParser('Trackstormsbot')
     parser.add_argument('-c', '--camera', type=int, default=0, help='Camera index')
+    parser.add_argument('--source', type=str, default='camera', choices=SOURCES, help='Frame source')
+    parser.add_argument('--source_path', type=str, default=None, help='Video file or image directory for file source')
+    parser.add_argument('--fourcc',
+                        type=str,
+                        default=None,
+                        choices=VideoCaptureSource.FOURCCS,
+                        help='Capture format for the camera source')
+    parser.add_argument('--lores',
+                        type=int,
+                        nargs=2,
+                        default=None,
+                        help='Also capture a low resolution stream of this size for the detectors')
     parser.add_argument('-d',
                         '--detector',
                         type=str,
                         default='yunet',
                         choices=DETECTOR_MAP.keys(),
                         help='Name of detector model to use')
+    parser.add_argument('--autotune',
+                        action='store_true',
+                        help='Benchmark settings of the haarcascade or yunet detector at startup and keep the fastest')
+    parser.add_argument('--autotune_source',
+                        type=str,
+                        default=None,
+                        help='Video file or image directory to tune on (default: simulated faces)')
+    parser.add_argument('--autotune_cache',
+                        type=str,
+                        default=CACHE_PATH,
+                        help='File the tuned settings are stored in and loaded from on later runs')
     parser.add_argument('--motor_ports', type=str, nargs=2, default=['A', 'B'], help='Motor Ports (X-axis, Y-axis)')
     parser.add_argument('--distance_port', type=str, default='C', help='Distance Sensor Port')
+    parser.add_argument('--distance_rate', type=float, default=5, help='Distance sensor polling rate (Hz)')
     parser.add_argument('--disable_controller', action='store_true', help='Disable controller')
+    parser.add_argument('--controller',
+                        type=str,
+                        default='pid',
+                        choices=CONTROLLER_MAP.keys(),
+                        help='Motor control algorithm')
+    parser.add_argument('--pixels_per_degree',
+                        type=float,
+                        nargs=2,
+                        default=[10, 10],
+                        help='Image shift per degree of motor rotation (X, Y) for position feedback, 0 0 disables it')
     parser.add_argument('--detector_rate', type=int, default=30, help='Detector rate (FPS)')
     parser.add_argument('--gesture_rate', type=int, default=30, help='Gesture recogniser rate (FPS)')
+    parser.add_argument('--max_hands', type=int, default=1, help='Max hands classified per frame')
+    parser.add_argument('--gesture_threads', type=int, default=1, help='Gesture classifier interpreter threads')
+    parser.add_argument('--gesture_smoothing',
+                        type=int,
+                        default=1,
+                        help='Majority vote the gesture over this many frames (1 disables smoothing)')
+    parser.add_argument('--backend',
+                        type=str,
+                        default='thread',
+                        choices=BACKENDS,
+                        help='Run each detector in a thread or in its own worker process')
+    parser.add_argument('--fused',
+                        action='store_true',
+                        help='Recognise gestures around the face on the same frame as face detection')
+    parser.add_argument('--tracker',
+                        type=str,
+                        default=None,
+                        choices=TRACKER_MAP.keys(),
+                        help='Track faces between detector keyframes')
+    parser.add_argument('--keyframe_interval', type=int, default=10, help='Max tracked frames between keyframes')
+    parser.add_argument('--roi_expansion',
+                        type=float,
+                        default=None,
+                        help='Detect in a window this many times the last face size (disabled by default)')
+    parser.add_argument('--roi_misses', type=int, default=3, help='Misses before falling back to full frame detection')
+    parser.add_argument('--motion_gate',
+                        action='store_true',
+                        help='Reuse the last results instead of running the detectors while nothing moves')
+    parser.add_argument('--motion_threshold', type=int, default=8, help='Brightness change that counts as motion')
+    parser.add_argument('--max_reuse_age',
+                        type=float,
+                        default=1.0,
+                        help='Run the detectors at least this often (s) with --motion_gate')
+    parser.add_argument('--max_concurrent',
+                        type=int,
+                        default=None,
+                        help='Max detectors running inference at once (default: CPU count - 1)')
+    parser.add_argument('--control_rate', type=int, default=30, help='Control loop rate (Hz)')
+    parser.add_argument('--max_result_age',
+                        type=float,
+                        default=0.5,
+                        help='Stop instead of steering on detections of frames older than this (s)')
+    parser.add_argument('--stream_size', type=int, nargs=2, default=None, help='Resize the web feed to this size')
+    parser.add_argument('--stream_quality', type=int, default=80, help='Max JPEG quality of the web feed')
+    parser.add_argument('--stream_fps', type=int, default=15, help='Max frame rate of the web feed')
+    parser.add_argument('--stream_encoder',
+                        type=str,
+                        default='auto',
+                        choices=StreamEncoder.ENCODERS,
+                        help='JPEG encoder, auto uses simplejpeg when it is installed')
+    parser.add_argument('--server_overlay',
+                        action='store_true',
+                        help='Draw detections and stats into the video instead of in the browser')
+    parser.add_argument('--metadata_only',
+                        action='store_true',
+                        help='Only send detections and stats to the browser, no video')
+    parser.add_argument('--record',
+                        type=str,
+                        default=None,
+                        help='Record frames, detections, gestures, distance and motor commands to this directory')
+    parser.add_argument('--record_video',
+                        type=str,
+                        default='mjpg',
+                        choices=SessionRecorder.VIDEO_FORMATS,
+                        help='Record frames as MJPG video, lossless PNG images or not at all')
+    parser.add_argument('--show_latency', action='store_true', help='Overlay latency percentiles on the video feed')
+    parser.add_argument('--no_web', '--no-web', action='store_true', help='Run headless without the web interface')
+    parser.add_argument('--port', type=int, default=5000, help='Web interface port')
+    parser.add_argument('--server',
+                        type=str,
+                        default='werkzeug',
+                        choices=SERVERS,
+                        help='Web server, waitress is a production WSGI server (pip install waitress)')
+    parser.add_argument('--server_threads',
+                        type=int,
+                        default=8,
+                        help='Request threads of the waitress server, every open video or event stream holds one')
+    parser.add_argument('--debug', action='store_true', help='Run the web interface with the Flask debugger')
+    parser.add_argument('--warm_up', type=int, default=2, help='Warm up inferences per model at startup (0 disables)')
+    parser.add_argument('--rigs',
+                        type=str,
+                        default=None,
+                        help='JSON file listing the rigs, each an id and the options that differ from the command line')
+    parser.add_argument('--sim',
+                        action='store_true',
+                        help='Simulate the camera, motors and distance sensor instead of using the Build HAT')
+    parser.add_argument('--sim_speed', type=float, default=1.0, help='Run the simulation this many times faster')
     return parser.parse_args()
 
 
-def get_detector(detector_name, camera, rate, **kwargs):
+def get_detector(detector_name, camera, rate, backend='thread', **kwargs):
     detector_class = DETECTOR_MAP[detector_name]
-    return detector_class(camera, rate, **kwargs)
+    return get_backend_detector(backend, detector_class, camera, rate, **kwargs)
 
 
-def video_stream():
-    args = get_args()
+def scale_rate(rate, time_scale):
+    return rate if rate <= 0 else max(1, int(rate * time_scale))
 
-    camera = CameraStream(args.camera)
-    detector = get_detector(args.detector, camera, args.detector_rate)
-    gesture_recogniser = MediapipeRecogniser(camera, args.gesture_rate)
-    controller = MotorController(args.motor_ports)
-    distance_sensor = DistanceSensorController(args.distance_port)
 
-    camera.open()
-    gesture_recogniser.start()
-    detector.start()
+def load_profile(args):
+    # Tuned settings of the face detector, measured now with --autotune or by an earlier run on this machine
+    if args.detector not in REFERENCES:
+        return None
+    cache = ProfileCache(args.autotune_cache)
+    if args.autotune:
+        profile = autotune(args.detector, sample_frames(args.autotune_source))
+        cache.save(args.detector, profile)
+    else:
+        profile = cache.load(args.detector)
+    if profile is not None:
+        log.info(f'Using {args.detector} profile {profile["config"]}: '
+                 f'{profile["latency_ms"]:.1f} ms, agreement {profile["agreement"]:.2f}')
+    return profile
 
-    frame_size = camera.size()
-    frame_middle = (frame_size[0] // 2, frame_size[1] // 2)
 
-    while (camera.is_opened()):
-        frame = camera.read()
+def build_service(args, profile=None, scheduler=None, model_pool=None, hat=None, rig_id=None):
+    lores_size = None if args.lores is None else tuple(args.lores)
+    pixels_per_degree = tuple(args.pixels_per_degree) if any(args.pixels_per_degree) else None
+    motor_class = sensor_class = rig = None
+    time_scale = 1
+    if args.sim:
+        # Everything that happens in the simulated world runs sim_speed times faster, so do the loops watching it
+        time_scale = args.sim_speed
+        rig = SimulatedRig(pixels_per_degree=pixels_per_degree or (10, 10), time_scale=time_scale)
+        source = rig.source(lores_size=lores_size)
+        motor_class, sensor_class = rig.motor, rig.distance_sensor
+    else:
+        source = get_source(args.source,
+                            camera=args.camera,
+                            path=args.source_path,
+                            fourcc=args.fourcc,
+                            lores_size=lores_size)
+    camera = CameraStream(source)
+    detector_kwargs = {} if profile is None else dict(profile['config'])
+    pool_kwargs = {} if model_pool is None else {'model_pool': model_pool}
+    detector_kwargs.update(pool_kwargs)
+    detector_rate = scale_rate(args.detector_rate, time_scale)
+    gesture_rate = scale_rate(args.gesture_rate, time_scale)
+    if args.fused:
+        # Faces and hands from the same frame, the wrapped detectors run in the fused detector's thread
+        if args.tracker is not None:
+            raise ValueError('--fused can not be combined with --tracker')
+        if args.backend != 'thread':
+            raise ValueError('--fused needs the thread backend, both detectors run in the fused detector thread')
+        face_detector = get_detector(args.detector, camera, detector_rate, **detector_kwargs)
+        hand_recogniser = MediapipeRecogniser(
+            camera,
+            max_num_hands=args.max_hands,
+            num_threads=args.gesture_threads,
+            smoothing_window=args.gesture_smoothing,
+            static_image_mode=True,
+            **pool_kwargs,
+        )
+        detector = FusedPerception(camera, face_detector, hand_recogniser, detector_rate)
+    elif args.tracker is not None:
+        # The tracker runs at camera rate and calls the detector on keyframes from its own thread
+        if args.backend != 'thread':
+            raise ValueError('--tracker needs the thread backend, keyframes are detected in the tracker thread')
+        face_detector = get_detector(args.detector, camera, detector_rate, **detector_kwargs)
+        detector = TrackedDetector(
+            camera,
+            face_detector,
+            tracker=args.tracker,
+            keyframe_interval=args.keyframe_interval,
+            keyframe_rate=detector_rate,
+        )
+    else:
+        face_detector = detector = get_detector(args.detector, camera, detector_rate, args.backend, **detector_kwargs)
 
-        if frame is None:
-            continue
+    if args.roi_expansion is not None:
+        face_detector.enable_roi(args.roi_expansion, args.roi_misses)
 
-        detections, _ = detector.read()
-        gesture_detections, gesture = gesture_recogniser.read()
+    # Face detection goes ahead of gesture recognition when the CPU is saturated
+    scheduler = scheduler or DetectorScheduler(max_concurrent=args.max_concurrent)
+    scheduler.register(detector, priority=1)
 
-        if len(detections) > 0:
-            detection = detections[0]
-        else:
-            detection = None
-
-        frame_vis = camera.read()
-
-        if not args.disable_controller:
-            if detection is not None:
-                relative_size = detection[2] * detection[3] / (frame_size[0] * frame_size[1])
-                middle = calculate_middle_xywh(detection)
-                frame_vis = visualise_detection(frame_vis, detection)
-                frame_vis = visualise_landmarks(frame_vis, gesture_detections)
-                controller.move_to_middle(
-                    frame_middle=frame_middle,
-                    detection_middle=middle,
-                    detection_size=relative_size,
-                )
-            else:
-                controller.stop()
-
-        if gesture == 'point':
-            distance_sensor.set_eyes(100, 100, 100, 100)
+    gesture_recogniser = None
+    if not args.fused:
+        gesture_recogniser = get_backend_detector(
+            args.backend,
+            MediapipeRecogniser,
+            camera,
+            gesture_rate,
+            max_num_hands=args.max_hands,
+            num_threads=args.gesture_threads,
+            smoothing_window=args.gesture_smoothing,
+            **pool_kwargs,
+        )
+        scheduler.register(gesture_recogniser, priority=0)
+
+    if args.motion_gate:
+        for gated in filter(None, (detector, gesture_recogniser)):
+            gated.enable_motion_gate(args.motion_threshold, max_reuse_age=args.max_reuse_age)
+
+    # All Build HAT traffic goes through one worker thread, off the control and video paths
+    controller = distance_sensor = None
+    if args.disable_controller:
+        hat = None
+    else:
+        hat = hat or BuildHatWorker()
+        if args.controller == 'pid':
+            controller = PIDMotorController(args.motor_ports,
+                                            hat=hat,
+                                            motor_class=motor_class,
+                                            pixels_per_degree=pixels_per_degree)
         else:
-            distance_sensor.set_eyes(0, 0, 0, 0)
+            controller = CONTROLLER_MAP[args.controller](args.motor_ports, hat=hat, motor_class=motor_class)
+        distance_sensor = DistanceSensorController(args.distance_port,
+                                                   hat=hat,
+                                                   poll_rate=args.distance_rate * time_scale,
+                                                   sensor_class=sensor_class)
+
+    recorder = None
+    if args.record is not None:
+        # A directory per rig
+        record_path = args.record if rig_id is None else os.path.join(args.record, rig_id)
+        recorder = SessionRecorder(record_path,
+                                   camera.subscribe(),
+                                   camera.size(),
+                                   fps=source.fps() or 30,
+                                   video=args.record_video)
+
+    return TrackingService(
+        camera,
+        detector,
+        gesture_recogniser,
+        controller,
+        distance_sensor,
+        control_rate=scale_rate(args.control_rate, time_scale),
+        disable_controller=args.disable_controller,
+        show_latency=args.show_latency,
+        hat=hat,
+        stream_size=None if args.stream_size is None else tuple(args.stream_size),
+        stream_quality=args.stream_quality,
+        stream_fps=args.stream_fps,
+        stream_encoder=args.stream_encoder,
+        server_overlay=args.server_overlay,
+        metadata_only=args.metadata_only,
+        rig_id=rig_id,
+        model_pool=model_pool,
+        recorder=recorder,
+        max_result_age=args.max_result_age / time_scale,
+    )
+
+
+def build_services(args, profile=None):
+    if args.rigs is None:
+        return {'0': build_service(args, profile)}
+
+    # Every rig has its own camera and controllers. They share the detector scheduler, which lets the detectors
+    # of all cameras take turns fairly, and the models, which are loaded once per configuration
+    if args.backend != 'thread':
+        raise ValueError('--rigs needs the thread backend, models are not shared with worker processes')
+    with open(args.rigs) as f:
+        configs = json.load(f)
+    scheduler = DetectorScheduler(max_concurrent=args.max_concurrent)
+    model_pool = ModelPool(max_instances=scheduler.max_concurrent())
+    # Simulated rigs have their own hardware, real ones are all on the one Build HAT
+    hat = BuildHatWorker()
+
+    rigs = {}
+    for index, config in enumerate(configs):
+        rig_id = str(config.get('id', index))
+        options = {name: value for name, value in config.items() if name != 'id'}
+        unknown = set(options) - set(vars(args))
+        if unknown:
+            raise ValueError(f'Unknown options for rig {rig_id}: {", ".join(sorted(unknown))}')
+        if rig_id in rigs:
+            raise ValueError(f'Duplicate rig id {rig_id}')
+        rig_args = argparse.Namespace(**{**vars(args), **options})
+        rigs[rig_id] = build_service(rig_args,
+                                     profile,
+                                     scheduler=scheduler,
+                                     model_pool=model_pool,
+                                     hat=None if rig_args.sim else hat,
+                                     rig_id=rig_id)
+    return rigs
+
+
+def serve(args):
+    # Never with the reloader, it would start a second service fighting over the camera and motors
+    if args.server == 'waitress':
+        from waitress import serve as waitress_serve
+        waitress_serve(app, host='0.0.0.0', port=args.port, threads=args.server_threads)
+    else:
+        app.run(host='0.0.0.0', port=args.port, debug=args.debug, use_reloader=False, threaded=True)
 
-        stats = {
-            'FPS (Camera)': int(camera.fps()),
-            'FPS (Detector)': int(detector.fps()),
-            'FPS (Gesture)': int(gesture_recogniser.fps()),
-            'Distance (cm)': distance_sensor.get_distance(),
-            'Gesture': gesture,}
 
-        frame_vis = visualise_stats(frame_vis, stats)
+def get_service(rig_id):
+    # The top level routes are those of the first rig
+    if rig_id is None:
+        return next(iter(services.values()))
+    if rig_id not in services:
+        abort(404)
+    return services[rig_id]
 
-        ret, buffer = cv2.imencode('.jpeg', frame_vis)
-        frame_vis = buffer.tobytes()
-        yield (b'--frame\r\n'
-               b'Content-type: image/jpeg\r\n\r\n' + frame_vis + b'\r\n')
 
-    camera.close()
+@app.route('/', defaults={'rig_id': None})
+@app.route('/rig/<rig_id>/')
+def index(rig_id):
+    service = get_service(rig_id)
+    return render_template('index.html',
+                           rig_id=service.rig_id(),
+                           rigs=list(services.keys()),
+                           metadata_only=service.metadata_only())
 
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+@app.route('/video_feed', defaults={'rig_id': None})
+@app.route('/rig/<rig_id>/video_feed')
+def video_feed(rig_id):
+    service = get_service(rig_id)
+    if service.metadata_only():
+        abort(404)
+    return Response(mjpeg_stream(service.broadcaster().subscribe()),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
-@app.route('/video_feed')
-def video_feed():
-    return Response(video_stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
+@app.route('/events', defaults={'rig_id': None})
+@app.route('/rig/<rig_id>/events')
+def events(rig_id):
+    return Response(sse_stream(get_service(rig_id).events().subscribe()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/stats', defaults={'rig_id': None})
+@app.route('/rig/<rig_id>/stats')
+def stats(rig_id):
+    return jsonify({name: str(value) for name, value in get_service(rig_id).stats().items()})
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
-    app.run(host='0.0.0.0', debug=True)
+    startup = StartupTimer(START_TIME)
+    startup.record('imports', time.perf_counter() - START_TIME)
+    args = get_args()
+
+    with startup.phase('autotune'):
+        profile = load_profile(args)
+    # Models are loaded while building, and the selected ones only
+    with startup.phase('build'):
+        services.update(build_services(args, profile))
+    if args.warm_up > 0:
+        with startup.phase('warm_up'):
+            for service in services.values():
+                service.warm_up(args.warm_up)
+    with startup.phase('start'):
+        for service in services.values():
+            service.start()
+    startup.finish()
+
+    try:
+        if args.no_web:
+            for service in services.values():
+                service.wait()
+        else:
+            serve(args)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for service in services.values():
+            service.stop()
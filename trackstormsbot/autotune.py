@@ -0,0 +1,219 @@
+import itertools
+import json
+import logging
+import os
+import platform
+import time
+
+import cv2
+import numpy as np
+
+from trackstormsbot.camera import FrameBus
+from trackstormsbot.detections import box_iou
+from trackstormsbot.detectors import DETECTOR_MAP, DNN_BACKENDS, DNN_TARGETS
+from trackstormsbot.preprocess import PreprocessCache
+from trackstormsbot.simulation import SimulatedRig
+from trackstormsbot.sources import FileSource
+
+log = logging.getLogger(__name__)
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'trackstormsbot', 'autotune.json')
+
+# Accurate but slow settings the candidates are compared against
+REFERENCES = {
+    'haarcascade': dict(det_frame_size=(320, 240), scale_factor=1.05),
+    'yunet': dict(det_frame_size=(320, 240)),}
+
+
+def thread_counts():
+    # Powers of two up to the number of cores
+    cores = os.cpu_count() or 1
+    return [count for count in (1, 2, 4, 8) if count <= cores]
+
+
+def dnn_configs():
+    # Backend and target pairs this OpenCV build can actually run
+    configs = []
+    for backend, backend_id in DNN_BACKENDS.items():
+        if backend == 'default':
+            continue
+        available = cv2.dnn.getAvailableTargets(backend_id)
+        configs.extend((backend, target) for target, target_id in DNN_TARGETS.items() if target_id in available)
+    return configs or [('default', 'cpu')]
+
+
+def candidates(detector_name):
+    if detector_name == 'haarcascade':
+        for size, scale_factor, threads in itertools.product([(320, 200), (256, 192), (192, 144), (160, 120)],
+                                                             [1.1, 1.2, 1.3], thread_counts()):
+            yield {'det_frame_size': size, 'scale_factor': scale_factor, 'num_threads': threads}
+    elif detector_name == 'yunet':
+        for size, (backend, target), threads in itertools.product([(160, 120), (128, 96), (96, 72)], dnn_configs(),
+                                                                  thread_counts()):
+            yield {'det_frame_size': size, 'dnn_backend': backend, 'dnn_target': target, 'num_threads': threads}
+    else:
+        raise ValueError(f'Autotuning is not supported for {detector_name}')
+
+
+def sample_frames(source_path=None, size=(640, 480), count=12):
+    # Frames of a recording, or the simulated face at different sizes and positions spread over the frame
+    if source_path is not None:
+        source = FileSource(source_path, size, loop=False, realtime=False)
+        source.open()
+        return [image for _, image in zip(range(count), source.frames())]
+
+    rng = np.random.default_rng(0)
+    frames = []
+    for index in range(count):
+        rig = SimulatedRig(frame_size=size, face_size=(60, 100, 140)[index % 3], seed=index)
+        frames.append(rig.render(rng.uniform(-1, 1, 2) * (20, 14)))
+    return frames
+
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo') as f:
+            info = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        info = {}
+    # A Raspberry Pi only reports the board model, other machines the processor name
+    for field in ('Model', 'model name', 'Hardware'):
+        for key, value in info.items():
+            if key.strip() == field:
+                return value.strip()
+    return platform.processor() or platform.machine()
+
+
+class _SampleCamera:
+    # Camera stand-in publishing the sample frames one by one
+
+    def __init__(self, size):
+        self._size = size
+        self._bus = FrameBus()
+        self._cache = PreprocessCache()
+
+    def publish(self, image):
+        return self._bus.publish(image)
+
+    def subscribe(self):
+        return self._bus.subscribe()
+
+    def cache(self):
+        return self._cache
+
+    def size(self):
+        return self._size
+
+    def fps(self):
+        return -1
+
+    def is_opened(self):
+        return True
+
+
+def run_config(detector_name, frames, config, repeats=2):
+    # Boxes found on every frame, and the median preprocessing plus inference time in milliseconds
+    camera = _SampleCamera((frames[0].shape[1], frames[0].shape[0]))
+    detector = DETECTOR_MAP[detector_name](camera, -1, **config)
+    detector.warm_up()
+
+    boxes = []
+    latencies = []
+    for repeat in range(repeats):
+        for image in frames:
+            frame = camera.publish(image)
+            start_time = time.perf_counter()
+            detections, _ = detector.process(detector.preprocess(frame))
+            latencies.append(time.perf_counter() - start_time)
+            if repeat == 0:
+                boxes.append(detector.update_roi(detections).boxes)
+    return boxes, float(np.median(latencies) * 1000)
+
+
+def agreement(boxes, reference_boxes, min_iou=0.5):
+    # Mean F1 score of the boxes against the reference boxes, a frame where both found nothing agrees fully
+    scores = []
+    for found, expected in zip(boxes, reference_boxes):
+        if len(found) == 0 and len(expected) == 0:
+            scores.append(1.0)
+            continue
+        matched = 0
+        if len(found) > 0 and len(expected) > 0:
+            iou = box_iou(found, expected)
+            # Greedy one to one matching, best overlaps first
+            while iou.size > 0 and iou.max() >= min_iou:
+                row, column = np.unravel_index(iou.argmax(), iou.shape)
+                iou[row, :] = 0
+                iou[:, column] = 0
+                matched += 1
+        scores.append(2 * matched / (len(found) + len(expected)))
+    return float(np.mean(scores))
+
+
+def autotune(detector_name, frames, min_agreement=0.9, repeats=2):
+    # The fastest candidate that agrees well enough with the reference, or the one agreeing best if none does
+    reference_boxes, reference_latency = run_config(detector_name, frames, REFERENCES[detector_name], repeats)
+    log.info(f'Autotune {detector_name} reference: {reference_latency:.1f} ms')
+
+    results = []
+    for config in candidates(detector_name):
+        try:
+            boxes, latency = run_config(detector_name, frames, config, repeats)
+        except cv2.error as e:
+            log.warning(f'Autotune {detector_name} skipped {config}: {e}')
+            continue
+        score = agreement(boxes, reference_boxes)
+        log.info(f'Autotune {detector_name} {config}: {latency:.1f} ms, agreement {score:.2f}')
+        results.append({'config': config, 'latency_ms': latency, 'agreement': score})
+    if not results:
+        raise RuntimeError(f'No {detector_name} configuration could be run')
+
+    accepted = [result for result in results if result['agreement'] >= min_agreement]
+    if accepted:
+        best = min(accepted, key=lambda result: result['latency_ms'])
+    else:
+        best = max(results, key=lambda result: (result['agreement'], -result['latency_ms']))
+    # The thread count is process wide, so later detectors are not measured with the candidates' last setting
+    cv2.setNumThreads(-1)
+
+    return {
+        **best,
+        'reference_latency_ms': reference_latency,
+        'frames': len(frames),
+        'candidates': results,}
+
+
+class ProfileCache:
+    # Tuned detector settings in a JSON file, only valid for the CPU and OpenCV version they were measured on
+
+    def __init__(self, path=CACHE_PATH):
+        self._path = path
+
+    def key(self):
+        return f'{cpu_model()} / OpenCV {cv2.__version__}'
+
+    def _read(self):
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, detector_name):
+        profile = self._read().get(self.key(), {}).get(detector_name)
+        if profile is None:
+            return None
+        # JSON turns the size tuples into lists
+        config = dict(profile['config'])
+        if 'det_frame_size' in config:
+            config['det_frame_size'] = tuple(config['det_frame_size'])
+        return {**profile, 'config': config}
+
+    def save(self, detector_name, profile):
+        profiles = self._read()
+        # Without the measurements of every candidate, they are only useful right after tuning
+        stored = {name: value for name, value in profile.items() if name != 'candidates'}
+        profiles.setdefault(self.key(), {})[detector_name] = stored
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        with open(self._path, 'w') as f:
+            json.dump(profiles, f, indent=2)
@@ -0,0 +1,200 @@
+import inspect
+import logging
+import multiprocessing as mp
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from trackstormsbot.detections import Detections
+from trackstormsbot.detectors import Detector
+from trackstormsbot.metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+BACKENDS = ['thread', 'process']
+
+
+class _WorkerCamera:
+    # Stands in for the camera inside a worker process, frames arrive over shared memory instead
+
+    def __init__(self, size):
+        self._size = size
+
+    def size(self):
+        return self._size
+
+    def subscribe(self):
+        return None
+
+    def cache(self):
+        return None
+
+    def fps(self):
+        return -1
+
+    def is_opened(self):
+        return True
+
+
+def _detector_worker(detector_class, camera_size, rate, kwargs, task_queue, result_queue):
+    # Only ready once the model is loaded and warmed up
+    detector = detector_class(_WorkerCamera(camera_size), rate, **kwargs)
+    detector.warm_up()
+    result_queue.put((0, None))
+
+    shm = None
+    frame = None
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+
+            task_id, shm_name, shape, dtype, roi = task
+            # The frame is cropped to the region of interest already, the detector only needs to know the zoom
+            detector.set_roi(roi)
+            if shm is None or shm.name != shm_name:
+                if shm is not None:
+                    shm.close()
+                shm = shared_memory.SharedMemory(name=shm_name)
+            frame = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+            start_time = time.perf_counter()
+            cpu_start = time.process_time()
+            try:
+                detections, labels = detector.process(frame)
+            except Exception:
+                log.exception(f'{detector_class.__name__} worker failed on frame')
+                detections, labels = Detections(), []
+            # The worker's own CPU time so far goes along, the parent can't see it until the worker has exited
+            cpu_time = time.process_time()
+            inference_time = time.perf_counter() - start_time
+            result_queue.put((task_id, (detections, labels, inference_time, cpu_time - cpu_start, cpu_time)))
+    finally:
+        if shm is not None:
+            frame = None
+            shm.close()
+
+
+class ProcessDetector(Detector):
+    START_TIMEOUT = 60.0
+    RESULT_TIMEOUT = 5.0
+
+    def __init__(self, detector_class, camera, rate=-1, **kwargs):
+        # The wrapped detector's frame size decides the preprocessing done in this process
+        det_frame_size = kwargs.get(
+            'det_frame_size',
+            inspect.signature(detector_class.__init__).parameters['det_frame_size'].default,
+        )
+        super().__init__(camera, rate, det_frame_size)
+        self.INTERPOLATION = detector_class.INTERPOLATION
+        self.COLOR_TRANSFORM = detector_class.COLOR_TRANSFORM
+        self._detector_class = detector_class
+        self._name = detector_class.__name__
+        self._ipc_time = 0
+        self._worker_cpu = 0
+        self._task_id = 0
+        self._shm = None
+        self._shm_frame = None
+
+        context = mp.get_context('spawn')
+        self._task_queue = context.Queue(maxsize=1)
+        self._result_queue = context.Queue(maxsize=1)
+        self._process = context.Process(
+            target=_detector_worker,
+            args=(detector_class, camera.size(), rate, kwargs, self._task_queue, self._result_queue),
+            name=f'{detector_class.__name__}Worker',
+            daemon=True,
+        )
+
+    def warm_up(self, iterations=2):
+        # Spawning the worker, loading the model and warming it up there is the slow part of starting
+        self._launch()
+
+    def start(self):
+        self._launch()
+        super().start()
+
+    def _launch(self):
+        if self._process.pid is not None:
+            return
+        self._process.start()
+        self._result_queue.get(timeout=self.START_TIMEOUT)
+        log.info(f'Started {self._detector_class.__name__} in worker process {self._process.pid}')
+
+    def detect(self):
+        try:
+            super().detect()
+        finally:
+            self._shutdown()
+
+    def process(self, frame):
+        if self._shm is None or self._shm_frame.shape != frame.shape:
+            self._allocate(frame)
+        self._shm_frame[...] = frame
+
+        start_time = time.perf_counter()
+        self._task_id += 1
+        self._task_queue.put((self._task_id, self._shm.name, frame.shape, frame.dtype.str, self._roi))
+        try:
+            # Results of tasks that previously timed out are discarded
+            task_id = None
+            while task_id != self._task_id:
+                task_id, result = self._result_queue.get(timeout=self.RESULT_TIMEOUT)
+        except queue.Empty:
+            if not self._process.is_alive():
+                log.error(f'{self._detector_class.__name__} worker process died')
+                self.stop()
+            return Detections(), []
+
+        detections, labels, inference_time, inference_cpu, worker_cpu = result
+        # Time spent on the round trip that was not spent on inference
+        elapsed = time.perf_counter() - start_time - inference_time
+        self._ipc_time = 0.9 * self._ipc_time + 0.1 * elapsed
+        # CPU time of the inference in the worker, the detector thread only counts its own
+        self._offloaded_cpu = inference_cpu
+        self._worker_cpu = worker_cpu
+        REGISTRY.observe('stage_latency', inference_time, stage='inference', detector=self._name)
+        REGISTRY.observe('stage_latency', elapsed, stage='ipc', detector=self._name)
+        return detections, labels
+
+    def worker_cpu(self):
+        # CPU seconds the worker process had used when it returned the latest result
+        return self._worker_cpu
+
+    def ipc_time(self):
+        # Smoothed inter-process overhead per frame in milliseconds
+        return self._ipc_time * 1000
+
+    def stats(self):
+        return {**super().stats(), f'IPC ms ({self._detector_class.__name__})': f'{self.ipc_time():.1f}'}
+
+    def _allocate(self, frame):
+        self._release()
+        self._shm = shared_memory.SharedMemory(create=True, size=frame.nbytes)
+        self._shm_frame = np.ndarray(frame.shape, dtype=frame.dtype, buffer=self._shm.buf)
+
+    def _release(self):
+        if self._shm is not None:
+            self._shm_frame = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def _shutdown(self):
+        try:
+            self._task_queue.put(None, timeout=1.0)
+        except queue.Full:
+            pass
+        self._process.join(timeout=self.RESULT_TIMEOUT)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._release()
+
+
+def get_backend_detector(backend, detector_class, camera, rate, **kwargs):
+    if backend == 'process':
+        return ProcessDetector(detector_class, camera, rate, **kwargs)
+    return detector_class(camera, rate, **kwargs)
@@ -1,49 +1,144 @@
 import logging
 import time
-from threading import Thread
+from collections import namedtuple
+from threading import Condition, Thread
 
-import cv2
+from trackstormsbot.metrics import REGISTRY
+from trackstormsbot.preprocess import PreprocessCache
+from trackstormsbot.sources import VideoCaptureSource
 
 log = logging.getLogger(__name__)
 
+# Immutable camera frame. The image is a read-only array shared by all consumers,
+# call image.copy() before drawing on it.
+Frame = namedtuple('Frame', ['image', 'seq', 'timestamp'])
+
+
+class FrameBus:
+
+    def __init__(self):
+        self._frame = None
+        self._seq = 0
+        self._closed = False
+        self._condition = Condition()
+
+    def publish(self, image, timestamp=None):
+        image.setflags(write=False)
+        with self._condition:
+            self._seq += 1
+            self._frame = Frame(image, self._seq, time.time() if timestamp is None else timestamp)
+            self._condition.notify_all()
+            return self._frame
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def is_closed(self):
+        return self._closed
+
+    def latest(self):
+        return self._frame
+
+    def wait(self, last_seq=0, timeout=None):
+        # Block until a frame newer than last_seq is published, returns None on timeout or close
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or (self._frame is not None and self._frame.seq > last_seq),
+                                     timeout)
+            frame = self._frame
+        if frame is None or frame.seq <= last_seq:
+            return None
+        return frame
+
+    def subscribe(self):
+        return FrameReader(self)
+
+
+class FrameReader:
+
+    def __init__(self, bus):
+        self._bus = bus
+        self._last_seq = 0
+        self._skipped = 0
+        self._last_skipped = 0
+
+    def next(self, timeout=None):
+        frame = self._bus.wait(self._last_seq, timeout)
+        if frame is None:
+            return None
+
+        # Frames published since the previous read were never seen by this consumer
+        self._last_skipped = frame.seq - self._last_seq - 1 if self._last_seq > 0 else 0
+        self._skipped += self._last_skipped
+        self._last_seq = frame.seq
+        return frame
+
+    def wait(self, timeout=None):
+        # Block until there is a frame this consumer has not seen, without consuming it
+        return self._bus.wait(self._last_seq, timeout) is not None
+
+    def closed(self):
+        return self._bus.is_closed()
+
+    def last_seq(self):
+        return self._last_seq
+
+    def last_skipped(self):
+        return self._last_skipped
+
+    def skipped(self):
+        return self._skipped
+
 
 class CameraStream:
 
-    def __init__(self, index, size=(640, 480)):
+    def __init__(self, source, size=(640, 480)):
+        if isinstance(source, int):
+            source = VideoCaptureSource(source, size)
         self._stopped = False
-        self._status = False
-        self._frame = None
-        self._cap = cv2.VideoCapture(index)
-        if size is not None:
-            self._cap.set(cv2.CAP_PROP_FRAME_WIDTH, size[0])
-            self._cap.set(cv2.CAP_PROP_FRAME_HEIGHT, size[1])
-        self._size = (int(self._cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self._bus = FrameBus()
+        self._cache = PreprocessCache()
+        self._source = source
+        self._source.open()
+        self._size = self._source.size()
         self._fps = -1
+        self._capture_cpu = 0
         self._thread = Thread(target=self.update, args=())
 
     def open(self):
         self._stopped = False
-        log.info(f'Starting camera stream with size {self._size} and fps {self._cap.get(cv2.CAP_PROP_FPS)}')
+        log.info(f'Starting camera stream with size {self._size} and fps {self._source.fps()}')
         self._thread.start()
 
     def close(self):
         self._stopped = True
+        self._bus.close()
 
     def update(self):
-        reported_fps = int(self._cap.get(cv2.CAP_PROP_FPS))
+        reported_fps = max(1, int(self._source.fps() or 1))
         frame_count = 0
         start_time = time.time()
 
         while not self._stopped:
-            status, frame = self._cap.read()
-
-            self._frame = frame
-            self._status = status
+            # CPU time of this thread, so waiting for the camera is not counted but decoding and conversion are
+            cpu_start = time.thread_time()
+            frame, lores = self._source.read()
+            timestamp = time.time()
+            capture_cpu = time.thread_time() - cpu_start
 
-            if not self._status:
+            if frame is None:
                 self.close()
                 break
 
+            # Sources allocate a new array per frame, so it can be shared without copying
+            published = self._bus.publish(frame, timestamp)
+            if lores is not None:
+                self._cache.put(published, self._source.lores_size(), lores)
+
+            self._capture_cpu = 0.9 * self._capture_cpu + 0.1 * capture_cpu
+            REGISTRY.observe('stage_latency', capture_cpu, stage='capture_cpu')
+
             frame_count += 1
 
             if frame_count % reported_fps == 0:
@@ -51,11 +146,23 @@ class CameraStream:
                 frame_count = 0
                 start_time = time.time()
 
-        self._cap.release()
-        self._cap = None
+        self._source.close()
 
     def read(self):
-        return None if not self._status else self._frame.copy()
+        frame = self._bus.latest()
+        return None if frame is None else frame.image
+
+    def read_frame(self):
+        return self._bus.latest()
+
+    def wait_frame(self, last_seq=0, timeout=None):
+        return self._bus.wait(last_seq, timeout)
+
+    def subscribe(self):
+        return self._bus.subscribe()
+
+    def cache(self):
+        return self._cache
 
     def is_opened(self):
         return not self._stopped
@@ -65,3 +172,7 @@ class CameraStream:
 
     def fps(self):
         return self._fps
+
+    def capture_cpu(self):
+        # Smoothed CPU time spent capturing (and decoding) a frame in milliseconds
+        return self._capture_cpu * 1000
@@ -1,20 +1,40 @@
+import functools
 import logging
+import time
+from collections import deque
 
-from buildhat import DistanceSensor, Motor
+import numpy as np
 
 log = logging.getLogger(__name__)
 
 
+def _buildhat_class(name):
+    # Imported on first use, so the simulation runs on machines without the Build HAT library
+    import buildhat
+    return getattr(buildhat, name)
+
+
+def _send_command(hat, command, motor, function, *args, **kwargs):
+    # Through the Build HAT worker when there is one, so only the latest command per motor goes out
+    if hat is None:
+        function(*args, **kwargs)
+    else:
+        hat.submit((command, motor), functools.partial(function, *args, **kwargs))
+
+
 class MotorController:
 
-    def __init__(self, motor_ports):
-        self._motor_x = Motor(motor_ports[0])
-        self._motor_y = Motor(motor_ports[1])
+    def __init__(self, motor_ports, hat=None, motor_class=None):
+        motor_class = motor_class or _buildhat_class('Motor')
+        self._motor_x = motor_class(motor_ports[0])
+        self._motor_y = motor_class(motor_ports[1])
+        self._hat = hat
         # self.motor_x.set_speed_unit_rpm(True)
 
         self._x_movement = 'stop'
         self._y_movement = 'stop'
         self._target = (0, 0)
+        self._pwm_values = [0, 0]
 
     def _calculate_hor_speed(self, min_speed, max_speed, detection_size):
         return max(min_speed, min(max_speed, max_speed / (detection_size * 30)))
@@ -27,7 +47,8 @@ class MotorController:
                        ver_tolerance=0.2,
                        min_hor_speed=15,
                        max_hor_speed=50,
-                       ver_speed=3):
+                       ver_speed=3,
+                       timestamp=None):
         # move motors to keep detection middle in middle of frame
         if self._target == detection_middle:
             return
@@ -44,7 +65,7 @@ class MotorController:
                 # self.motor_x.start(-hor_speed)
                 # self.motor_x.pwm(-0.5)
                 # time.sleep(0.03)
-                self._motor_x.pwm(hor_speed / 100)
+                self._pwm(self._motor_x, hor_speed / 100)
         elif frame_middle[0] < detection_middle[0] - hor_tol_abs:
             if not self._x_movement == 'left':
                 log.info(f'move left {-hor_speed}')
@@ -52,14 +73,14 @@ class MotorController:
                 # self.motor_x.start(hor_speed)
                 # self.motor_x.pwm(0.5)
                 # time.sleep(0.03)
-                self._motor_x.pwm(-hor_speed / 100)
+                self._pwm(self._motor_x, -hor_speed / 100)
         else:
             if not self._x_movement == 'stop':
                 log.info('stop horizontal')
                 self._x_movement = 'stop'
                 # self.motor_x.start(0)
                 # self.motor_x.stop()
-                self._motor_x.pwm(0)
+                self._pwm(self._motor_x, 0)
 
         ver_tol_abs = frame_middle[1] * ver_tolerance
         if frame_middle[1] > detection_middle[1] + ver_tol_abs:
@@ -67,52 +88,262 @@ class MotorController:
                 log.info('move up')
                 self._y_movement = 'up'
                 # self.motor_y.start(-ver_speed)
-                self._motor_y.pwm(-ver_speed / 100)
+                self._pwm(self._motor_y, -ver_speed / 100)
         elif frame_middle[1] < detection_middle[1] - ver_tol_abs:
             if not self._y_movement == 'down':
                 log.info('move down')
                 self._y_movement = 'down'
                 # self.motor_y.start(ver_speed)
-                self._motor_y.pwm(ver_speed / 100)
+                self._pwm(self._motor_y, ver_speed / 100)
         else:
             if not self._y_movement == 'stop':
                 log.info('stop vertical')
                 self._y_movement = 'stop'
                 # self.motor_y.start(0)
                 # self.motor_y.stop()
-                self._motor_y.pwm(0)
+                self._pwm(self._motor_y, 0)
 
         self._target = detection_middle
 
+    def motors(self):
+        return self._motor_x, self._motor_y
+
     def to_position(self, x, y):
-        self._motor_x.run_to_position(x, blocking=False)
-        self._motor_y.run_to_position(y, blocking=False)
+        self._send('run_to_position', self._motor_x, self._motor_x.run_to_position, x, blocking=False)
+        self._send('run_to_position', self._motor_y, self._motor_y.run_to_position, y, blocking=False)
+
+    def pwm(self):
+        # Last commanded pwm of the X and Y motors
+        return tuple(self._pwm_values)
+
+    def _pwm(self, motor, value):
+        self._pwm_values[0 if motor is self._motor_x else 1] = value
+        self._send('pwm', motor, motor.pwm, value)
+
+    def _send(self, command, motor, function, *args, **kwargs):
+        _send_command(self._hat, command, motor, function, *args, **kwargs)
 
     def stop(self):
         if not self._x_movement == 'stop':
             log.info('stop horizontal')
             self._x_movement = 'stop'
-            self._motor_x.pwm(0)
+            self._pwm(self._motor_x, 0)
             # self.motor_x.stop()
 
         if not self._y_movement == 'stop':
             log.info('stop vertical')
             self._y_movement = 'stop'
-            self._motor_y.pwm(0)
+            self._pwm(self._motor_y, 0)
+
+
+class PID:
+
+    def __init__(self, kp, ki=0, kd=0, output_limit=1.0, integral_limit=None):
+        self._kp = kp
+        self._ki = ki
+        self._kd = kd
+        self._output_limit = output_limit
+        # Without a limit the integral alone can not saturate the output
+        self._integral_limit = integral_limit or (output_limit / ki if ki > 0 else 0)
+        self.reset()
+
+    def reset(self):
+        self._integral = 0
+        self._last_error = None
+
+    def update(self, error, dt):
+        self._integral = np.clip(self._integral + error * dt, -self._integral_limit, self._integral_limit)
+        derivative = 0 if self._last_error is None or dt <= 0 else (error - self._last_error) / dt
+        self._last_error = error
+        output = self._kp * error + self._ki * self._integral + self._kd * derivative
+        return float(np.clip(output, -self._output_limit, self._output_limit))
+
+
+class TargetPredictor:
+    # Smoothed target velocity, to extrapolate a detection to the moment a motor command takes effect
+
+    def __init__(self, smoothing=0.6, max_gap=0.5):
+        self._smoothing = smoothing
+        self._max_gap = max_gap
+        self.reset()
+
+    def reset(self):
+        self._position = None
+        self._velocity = np.zeros(2)
+        self._timestamp = None
+
+    def update(self, position, timestamp):
+        position = np.asarray(position, dtype=np.float64)
+        if self._timestamp is not None and timestamp <= self._timestamp:
+            # Same detection as last time
+            return
+        if self._timestamp is not None and timestamp - self._timestamp < self._max_gap:
+            velocity = (position - self._position) / (timestamp - self._timestamp)
+            self._velocity = self._smoothing * self._velocity + (1 - self._smoothing) * velocity
+        else:
+            self._velocity = np.zeros(2)
+        self._position = position
+        self._timestamp = timestamp
+
+    def predict(self, timestamp):
+        if self._position is None:
+            return None
+        return self._position + self._velocity * (timestamp - self._timestamp)
+
+    def velocity(self):
+        return self._velocity
+
+
+class PIDMotorController:
+    # Motor speed proportional to the predicted offset of the face from the frame middle.
+    # Errors are in half frames, signed so that a positive pwm reduces them (the tilt motor is mounted reversed)
+    AXIS_SIGNS = np.array([1, -1])
+    # Without position feedback the camera's motion since the frame was captured is unknown, and only
+    # gentler gains keep the loop stable at typical detector latencies
+    NO_FEEDBACK_GAIN = 0.2
+
+    def __init__(self,
+                 motor_ports,
+                 hat=None,
+                 motor_class=None,
+                 kp=(1.5, 0.8),
+                 ki=(0.5, 0.3),
+                 kd=(0.02, 0.005),
+                 max_pwm=(0.5, 0.15),
+                 deadband=0.03,
+                 actuation_delay=0.03,
+                 pixels_per_degree=None,
+                 position_rate=50,
+                 clock=time.time):
+        motor_class = motor_class or _buildhat_class('Motor')
+        self._motors = [motor_class(port) for port in motor_ports]
+        self._hat = hat
+        gain = 1 if pixels_per_degree is not None else self.NO_FEEDBACK_GAIN
+        self._pids = [PID(kp[axis] * gain, ki[axis] * gain, kd[axis] * gain, max_pwm[axis]) for axis in range(2)]
+        self._predictor = TargetPredictor()
+        self._deadband = deadband
+        self._actuation_delay = actuation_delay
+        self._pixels_per_degree = None if pixels_per_degree is None else np.array(pixels_per_degree, dtype=np.float64)
+        self._clock = clock
+        self._pwm_values = [0, 0]
+        self._last_update = None
+        self._positions = deque(maxlen=64)
+
+        # Named by port, the worker may be shared with the motors of other rigs
+        self._position_names = [f'position_{port}' for port in motor_ports]
+        if self._hat is not None and self._pixels_per_degree is not None:
+            for name, motor in zip(self._position_names, self._motors):
+                self._hat.poll(name, motor.get_position, position_rate)
+
+    def move_to_middle(self, frame_middle, detection_middle, detection_size=None, timestamp=None):
+        now = self._clock()
+        timestamp = now if timestamp is None else timestamp
+        dt = 0 if self._last_update is None else min(now - self._last_update, 0.1)
+        self._last_update = now
+
+        half_frame = np.array(frame_middle, dtype=np.float64)
+        error = self.AXIS_SIGNS * (half_frame - np.array(detection_middle, dtype=np.float64)) / half_frame
+
+        # With position feedback the target is tracked independent of the camera's own motion, so the
+        # error left when the command lands accounts for how far the motors turned since the frame was captured
+        positions = self._read_positions(now)
+        if positions is not None:
+            scale = self._pixels_per_degree / half_frame
+            target = error + self._position_at(timestamp) * scale
+            self._predictor.update(target, timestamp)
+            camera = positions + self._motor_velocity() * self._actuation_delay
+            error = self._predictor.predict(now + self._actuation_delay) - camera * scale
+
+        for axis in range(2):
+            if abs(error[axis]) < self._deadband:
+                self._pids[axis].reset()
+                self._set_pwm(axis, 0)
+            else:
+                self._set_pwm(axis, self._pids[axis].update(error[axis], dt))
+
+    def motors(self):
+        return tuple(self._motors)
+
+    def pwm(self):
+        return tuple(self._pwm_values)
+
+    def to_position(self, x, y):
+        for motor, position in zip(self._motors, (x, y)):
+            self._send('run_to_position', motor, motor.run_to_position, position, blocking=False)
+
+    def stop(self):
+        for axis in range(2):
+            self._pids[axis].reset()
+            self._set_pwm(axis, 0)
+        self._predictor.reset()
+        self._last_update = None
+
+    def _set_pwm(self, axis, value):
+        # Small changes are not worth a serial command
+        if abs(value - self._pwm_values[axis]) < 0.01 and (value != 0 or self._pwm_values[axis] == 0):
+            return
+        self._pwm_values[axis] = value
+        motor = self._motors[axis]
+        self._send('pwm', motor, motor.pwm, value)
+
+    def _send(self, command, motor, function, *args, **kwargs):
+        _send_command(self._hat, command, motor, function, *args, **kwargs)
+
+    def _read_positions(self, now):
+        if self._pixels_per_degree is None:
+            return None
+        if self._hat is None:
+            positions = [motor.get_position() for motor in self._motors]
+        else:
+            positions = [self._hat.value(name) for name in self._position_names]
+            if None in positions:
+                return None
+        positions = np.array(positions, dtype=np.float64)
+        self._positions.append((now, positions))
+        return positions
+
+    def _position_at(self, timestamp):
+        times = [sample[0] for sample in self._positions]
+        positions = np.array([sample[1] for sample in self._positions])
+        return np.array([np.interp(timestamp, times, positions[:, axis]) for axis in range(2)])
+
+    def _motor_velocity(self):
+        if len(self._positions) < 2:
+            return np.zeros(2)
+        (start_time, start), (end_time, end) = self._positions[-2], self._positions[-1]
+        if end_time <= start_time:
+            return np.zeros(2)
+        return (end - start) / (end_time - start_time)
 
 
 class DistanceSensorController:
     DEFAULT_EYE_STATE = (0, 0, 0, 0)
 
-    def __init__(self, port):
-        self._sensor = DistanceSensor(port)
+    def __init__(self, port, hat=None, poll_rate=5, sensor_class=None):
+        sensor_class = sensor_class or _buildhat_class('DistanceSensor')
+        self._sensor = sensor_class(port)
         self._eye_values = self.DEFAULT_EYE_STATE
+        self._hat = hat
+        self._poll_name = f'distance_{port}'
+        if self._hat is not None:
+            # Read in the background at its own rate, get_distance returns the last reading
+            self._hat.poll(self._poll_name, self._sensor.get_distance, poll_rate)
 
     def get_distance(self):
-        return self._sensor.get_distance()
+        if self._hat is None:
+            return self._sensor.get_distance()
+        return self._hat.value(self._poll_name)
 
     def set_eyes(self, right_upper, left_upper, right_lower, left_lower):
         new_eye_values = (right_upper, left_upper, right_lower, left_lower)
         if new_eye_values != self._eye_values:
-            self._sensor.eyes(*new_eye_values)
+            if self._hat is None:
+                self._sensor.eyes(*new_eye_values)
+            else:
+                self._hat.submit(('eyes', self._sensor), self._sensor.eyes, *new_eye_values)
             self._eye_values = new_eye_values
+
+
+CONTROLLER_MAP = {
+    'bang_bang': MotorController,
+    'pid': PIDMotorController,}
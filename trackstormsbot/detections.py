@@ -0,0 +1,68 @@
+import numpy as np
+
+
+def box_iou(boxes_a, boxes_b):
+    # Pairwise intersection over union of (x, y, w, h) boxes
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(1, -1, 4)
+    overlap = np.minimum(a[..., :2] + a[..., 2:], b[..., :2] + b[..., 2:]) - np.maximum(a[..., :2], b[..., :2])
+    intersection = np.clip(overlap, 0, None).prod(axis=-1)
+    return intersection / np.maximum(a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection, 1e-6)
+
+
+class Detections:
+    # Detection results of one frame as dense arrays: boxes (N, 4) as x, y, w, h in camera frame pixels,
+    # scores (N,) and optional landmarks (N, K, 2)
+    __slots__ = ('boxes', 'scores', 'landmarks', 'seq', 'timestamp')
+
+    def __init__(self, boxes=None, scores=None, landmarks=None, seq=None, timestamp=None):
+        self.boxes = np.zeros((0, 4), dtype=np.float32) if boxes is None else \
+            np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.scores = np.ones(len(self.boxes), dtype=np.float32) if scores is None else \
+            np.asarray(scores, dtype=np.float32).reshape(-1)
+        self.landmarks = None
+        if landmarks is not None:
+            landmarks = np.asarray(landmarks, dtype=np.float32)
+            self.landmarks = landmarks.reshape(len(self.boxes), -1, 2) if landmarks.size > 0 else \
+                np.zeros((len(self.boxes), 0, 2), dtype=np.float32)
+        self.seq = seq
+        self.timestamp = timestamp
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __getitem__(self, index):
+        return self.box(index)
+
+    def box(self, index):
+        return [int(v) for v in self.boxes[index]]
+
+    def to_list(self):
+        return self.boxes.astype(np.int32).tolist()
+
+    def points(self, index=None):
+        # Landmarks as integer (x, y) tuples, of one detection or all of them
+        if self.landmarks is None:
+            return []
+        landmarks = self.landmarks if index is None else self.landmarks[index:index + 1]
+        return [tuple(point) for point in landmarks.reshape(-1, 2).astype(np.int32).tolist()]
+
+    def best(self):
+        # Index of the most confident detection, the largest one on equal scores
+        if len(self) == 0:
+            return None
+        areas = self.boxes[:, 2] * self.boxes[:, 3]
+        return int(np.lexsort((areas, self.scores))[-1])
+
+    def scaled(self, scale_x, scale_y, offset_x=0, offset_y=0):
+        scale = np.array([scale_x, scale_y], dtype=np.float32)
+        offset = np.array([offset_x, offset_y], dtype=np.float32)
+        boxes = np.concatenate((self.boxes[:, :2] * scale + offset, self.boxes[:, 2:] * scale), axis=1)
+        landmarks = None if self.landmarks is None else self.landmarks * scale + offset
+        return Detections(boxes, self.scores, landmarks, self.seq, self.timestamp)
+
+    def stamped(self, seq, timestamp):
+        return Detections(self.boxes, self.scores, self.landmarks, seq, timestamp)
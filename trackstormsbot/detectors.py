@@ -1,25 +1,90 @@
 import logging
 import time
+from collections import namedtuple
 from threading import Thread
 
 import cv2
-import mediapipe as mp
+import numpy as np
+
+from trackstormsbot.detections import Detections
+from trackstormsbot.metrics import REGISTRY
+from trackstormsbot.motion import MotionGate
+from trackstormsbot.pool import PooledModel
+from trackstormsbot.preprocess import COLOR_TRANSFORMS
+from trackstormsbot.scheduler import DetectorScheduler
 
 log = logging.getLogger(__name__)
 
+# Results of one frame, published as a whole so readers never combine detections and labels of different frames.
+# seq and timestamp are those of the frame, None until the first frame is processed
+Result = namedtuple('Result', ['detections', 'labels', 'seq', 'timestamp'])
+
+# Only the backends and targets this OpenCV build knows about, older versions lack some of the constants
+DNN_BACKENDS = {
+    name: getattr(cv2.dnn, constant)
+    for name, constant in (
+        ('default', 'DNN_BACKEND_DEFAULT'),
+        ('opencv', 'DNN_BACKEND_OPENCV'),
+        ('timvx', 'DNN_BACKEND_TIMVX'),
+        ('cuda', 'DNN_BACKEND_CUDA'),
+    ) if hasattr(cv2.dnn, constant)}
+
+DNN_TARGETS = {
+    name: getattr(cv2.dnn, constant)
+    for name, constant in (
+        ('cpu', 'DNN_TARGET_CPU'),
+        ('cpu_fp16', 'DNN_TARGET_CPU_FP16'),
+        ('opencl', 'DNN_TARGET_OPENCL'),
+        ('npu', 'DNN_TARGET_NPU'),
+        ('cuda', 'DNN_TARGET_CUDA'),
+    ) if hasattr(cv2.dnn, constant)}
+
+
+def set_opencv_threads(num_threads):
+    # OpenCV's thread pool is shared by everything in the process, None keeps OpenCV's default
+    if num_threads is not None:
+        cv2.setNumThreads(num_threads)
+
 
 class Detector:
+    FRAME_TIMEOUT = 1.0
+    INTERPOLATION = cv2.INTER_AREA
+    COLOR_TRANSFORM = 'bgr'
 
-    def __init__(self, camera, rate=-1, det_frame_size=(320, 200)):
+    def __init__(self, camera, rate=-1, det_frame_size=(320, 200), model_pool=None):
         self._camera = camera
+        self._model_pool = model_pool
+        self._frame_reader = camera.subscribe()
+        self._cache = camera.cache()
         self._rate = rate
         self._det_frame_size = det_frame_size
         self._stopped = False
-        self._detections = []
-        self._labels = []
+        self._result = Result(Detections(), [], None, None)
         self._fps = 1
+        self._preprocess_time = 0
+        self._processed_frames = 0
+        self._latency = 0
+        self._frame = None
+        self._name = type(self).__name__
+        self._scheduler = None
+
+        # Region of interest around the last detection, disabled until enable_roi() is called
+        self._roi_expansion = None
+        self._roi_max_misses = 0
+        self._roi_target = None
+        self._roi_misses = 0
+        self._roi = None
+        self._roi_frames = 0
+
+        # Reuse of the last results while the scene is static, disabled until enable_motion_gate() is called
+        self._motion_gate = None
+        self._motion_skipped = 0
+        self._process_cpu = None
+        self._offloaded_cpu = 0
+        self._cpu_saved = 0
 
         camera_frame_size = self._camera.size()
+        self._camera_frame_size = camera_frame_size
         self._frame_scale_factor = (
             camera_frame_size[0] / self._det_frame_size[0],
             camera_frame_size[1] / self._det_frame_size[1],
@@ -27,44 +92,223 @@ class Detector:
         self._last_detection_time = 0
         self._thread = Thread(target=self.detect, args=())
 
+    def rate(self):
+        return self._rate
+
+    def det_frame_size(self):
+        return self._det_frame_size
+
+    def load_model(self, key, factory):
+        # Shared with the detectors of other rigs with the same configuration when there is a model pool,
+        # otherwise this detector's own. Either way borrow() it for each inference
+        if self._model_pool is None:
+            return PooledModel(factory)
+        return self._model_pool.get((type(self).__name__,) + key, factory)
+
+    def set_scheduler(self, scheduler):
+        self._scheduler = scheduler
+
     def start(self):
         self._stopped = False
+        if self._scheduler is None:
+            DetectorScheduler(max_concurrent=1).register(self)
         self._thread.start()
 
     def stop(self):
         self._stopped = True
+        if self._scheduler is not None:
+            self._scheduler.wake()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
 
     def read(self):
-        return self._detections, self._labels
+        result = self._result
+        return result.detections, result.labels
+
+    def result(self):
+        return self._result
+
+    def result_timestamp(self):
+        # Capture time of the frame the current results were detected on
+        return self._result.timestamp
+
+    def result_age(self):
+        # Seconds since the frame of the current results was captured, None before the first result
+        timestamp = self._result.timestamp
+        return None if timestamp is None else time.time() - timestamp
+
+    def next_frame(self):
+        # Blocks until the camera publishes a frame this detector has not seen yet
+        self._frame = self._frame_reader.next(timeout=self.FRAME_TIMEOUT)
+        return self._frame
 
     def get_frame(self):
-        frame = self._camera.read()
+        frame = self.next_frame()
 
-        # Resize frame to detection frame size
         if frame is not None:
-            frame = cv2.resize(frame, self._det_frame_size, interpolation=cv2.INTER_AREA)
+            frame = self.preprocess(frame)
 
         return frame
 
+    def warm_up(self, iterations=2):
+        # Run the model on a blank frame before start(), so one-off setup like memory allocation and graph
+        # initialisation is not paid on the first real frame. Nothing is recorded in the metrics
+        image = np.zeros((self._det_frame_size[1], self._det_frame_size[0], 3), dtype=np.uint8)
+        transform = COLOR_TRANSFORMS[self.COLOR_TRANSFORM]
+        if transform is not None:
+            image = transform(image)
+        for _ in range(iterations):
+            self.model_detection(image)
+
+    def enable_roi(self, expansion=3.0, max_misses=3):
+        self._roi_expansion = expansion
+        self._roi_max_misses = max_misses
+
+    def enable_motion_gate(self, threshold=8, min_changed=0.01, max_reuse_age=1.0):
+        self._motion_gate = MotionGate(self._cache, threshold, min_changed, max_reuse_age)
+
+    def preprocess(self, frame, roi=None):
+        # Resize frame (or the region of interest) to detection frame size,
+        # shared with other detectors through the camera cache. An explicit roi overrides the tracked one
+        start_time = time.perf_counter()
+        self._roi = self._get_roi() if roi is None else roi
+        image = self._cache.get(frame, self._det_frame_size, self.INTERPOLATION, self.COLOR_TRANSFORM, self._roi)
+        elapsed = time.perf_counter() - start_time
+        self._preprocess_time = 0.9 * self._preprocess_time + 0.1 * elapsed
+        REGISTRY.observe('stage_latency', elapsed, stage='preprocess', detector=self._name)
+        return image
+
+    def _get_roi(self):
+        if self._roi_expansion is None or self._roi_target is None:
+            return None
+
+        # Expanded window around the target with the aspect ratio of the detection frame,
+        # but never smaller than the detection frame itself
+        x, y, w, h = self._roi_target
+        aspect = self._det_frame_size[0] / self._det_frame_size[1]
+        roi_w = max(w * self._roi_expansion, h * self._roi_expansion * aspect, self._det_frame_size[0])
+        roi_w = int(min(roi_w, self._camera_frame_size[0], self._camera_frame_size[1] * aspect))
+        roi_h = int(roi_w / aspect)
+        if roi_w >= self._camera_frame_size[0] and roi_h >= self._camera_frame_size[1]:
+            return None
+
+        roi_x = int(min(max(0, x + w // 2 - roi_w // 2), self._camera_frame_size[0] - roi_w))
+        roi_y = int(min(max(0, y + h // 2 - roi_h // 2), self._camera_frame_size[1] - roi_h))
+        return roi_x, roi_y, roi_w, roi_h
+
+    def set_roi(self, roi):
+        # For a detector handed frames that were preprocessed elsewhere, like the copy in a worker process
+        self._roi = roi
+
+    def roi_ratio(self, processed_frames=None):
+        # Fraction of frames detected in a region of interest, None without ROI detection. A wrapped detector
+        # is handed the frame count of the detector driving it, it never counts its own
+        if self._roi_expansion is None:
+            return None
+        return self._roi_frames / max(1, self._processed_frames if processed_frames is None else processed_frames)
+
+    def roi_zoom(self):
+        # Magnification of the current region of interest compared to a full frame detection
+        return 1.0 if self._roi is None else self._camera_frame_size[0] / self._roi[2]
+
+    def update_roi(self, detections):
+        if self._roi is not None:
+            # Post processing scales with _frame_scale_factor as if the full frame was used,
+            # correct for the smaller window and add its offset
+            self._roi_frames += 1
+            roi_x, roi_y, roi_w, roi_h = self._roi
+            detections = detections.scaled(roi_w / self._camera_frame_size[0], roi_h / self._camera_frame_size[1],
+                                           roi_x, roi_y)
+
+        if self._roi_expansion is not None:
+            if len(detections) > 0:
+                self._roi_target = detections.box(detections.best())
+                self._roi_misses = 0
+            else:
+                # Fall back to full frame search after too many misses
+                self._roi_misses += 1
+                if self._roi_misses >= self._roi_max_misses:
+                    self._roi_target = None
+
+        return detections
+
     def fps(self):
         return self._fps
 
+    def latency(self):
+        # Smoothed time from frame capture until its result is available in milliseconds
+        return self._latency * 1000
+
+    def preprocess_time(self):
+        # Smoothed preprocessing time per frame in milliseconds
+        return self._preprocess_time * 1000
+
+    def skipped_frames(self):
+        return self._frame_reader.skipped()
+
+    def processed_frames(self):
+        return self._processed_frames
+
+    def motion_skip_ratio(self):
+        return self._motion_skipped / max(1, self._processed_frames)
+
+    def cpu_saved(self):
+        # Estimated CPU seconds not spent on inference thanks to the motion gate
+        return self._cpu_saved
+
+    def stats(self):
+        # Detector specific stats shown next to the FPS counters
+        stats = {}
+        if self._roi_expansion is not None:
+            stats['ROI ratio'] = f'{self.roi_ratio():.2f}'
+        if self._motion_gate is not None:
+            motion_stat = f'{self.motion_skip_ratio():.2f} / {self._cpu_saved:.1f}s'
+            stats[f'Motion skip / CPU saved ({self._name})'] = motion_stat
+        return stats
+
     def detect(self):
         frame_count = 0
 
         fps_timer = time.time()
         while not self._stopped:
-            start_time = time.time()
-
-            # Get frame
-            frame = self.get_frame()
-            if frame is None:
+            # Only compete for a turn once there is a frame this detector has not processed
+            if not self._frame_reader.wait(self.FRAME_TIMEOUT):
+                if not self._camera.is_opened():
+                    break
                 continue
 
-            # Run detection model and post process detections
-            # These functions should be implemented by the child class
-            output = self.model_detection(frame)
-            self._detections, self._labels = self.detection_post_process(output)
+            # Wait for our turn, then take the newest frame so no frame is ever processed twice
+            if not self._scheduler.acquire(self, lambda: self._stopped):
+                break
+
+            try:
+                frame = self.get_frame()
+                if frame is None:
+                    continue
+
+                if self._motion_gate is not None and self._motion_gate.is_static(self._frame):
+                    # Nothing moved since the frame the current results came from, they still hold for this one
+                    self._motion_skipped += 1
+                    self._cpu_saved += self._process_cpu or 0
+                    detections = self._result.detections.stamped(self._frame.seq, self._frame.timestamp)
+                    labels = self._result.labels
+                else:
+                    cpu_start = time.thread_time()
+                    detections, labels = self.process(frame)
+                    detections = self.update_roi(detections).stamped(self._frame.seq, self._frame.timestamp)
+                    # Including inference offloaded to a worker process
+                    process_cpu = time.thread_time() - cpu_start + self._offloaded_cpu
+                    self._process_cpu = process_cpu if self._process_cpu is None else \
+                        0.9 * self._process_cpu + 0.1 * process_cpu
+                self._result = Result(detections, labels, self._frame.seq, self._frame.timestamp)
+            finally:
+                self._scheduler.release(self)
+
+            self._processed_frames += 1
+            latency = time.time() - self._frame.timestamp
+            self._latency = 0.9 * self._latency + 0.1 * latency
+            REGISTRY.observe('stage_latency', latency, stage='result', detector=self._name)
 
             # Calculate detection rate
             frame_count += 1
@@ -76,18 +320,35 @@ class Detector:
 
             self._last_detection_time = time.time()
 
-            # Sleep to maintain detection rate
-            time.sleep(max(0, 1 / self._rate - (time.time() - start_time)))
+    def process(self, frame):
+        # Run detection model and post process detections
+        # These functions should be implemented by the child class
+        start_time = time.perf_counter()
+        output = self.model_detection(frame)
+        inference_end_time = time.perf_counter()
+        result = self.detection_post_process(output)
+        REGISTRY.observe('stage_latency', inference_end_time - start_time, stage='inference', detector=self._name)
+        REGISTRY.observe('stage_latency',
+                         time.perf_counter() - inference_end_time,
+                         stage='postprocess',
+                         detector=self._name)
+        return result
 
     def model_detection(self, frame):
         return []
 
     def detection_post_process(self, detections):
-        return detections, []
+        return Detections(), []
+
+    def _frame_scale(self):
+        # Scale factor from detection frame coordinates to camera frame coordinates, as (x, y, x, y)
+        return np.array(self._frame_scale_factor * 2, dtype=np.float32)
 
 
 class CascadeDetector(Detector):
     HAARCASCADE = 'trackstormsbot/configs/haarcascade_frontalface_default.xml'
+    # Also convert to grayscale and equalize histogram
+    COLOR_TRANSFORM = 'gray_eq'
 
     def __init__(self,
                  camera,
@@ -96,101 +357,127 @@ class CascadeDetector(Detector):
                  scale_factor=1.1,
                  min_neighbors=3,
                  min_size=(10, 10),
-                 max_size=(100, 100)):
-        super().__init__(camera, rate, det_frame_size)
+                 max_size=(100, 100),
+                 num_threads=None,
+                 model_pool=None):
+        super().__init__(camera, rate, det_frame_size, model_pool)
+        set_opencv_threads(num_threads)
         self._scale_factor = scale_factor
         self._min_neighbors = min_neighbors
         self._min_size = min_size
         self._max_size = max_size
-        self._cascade = cv2.CascadeClassifier(self.HAARCASCADE)
+        # Detection parameters are passed on every call, one cascade serves every configuration
+        self._cascade = self.load_model((), lambda: cv2.CascadeClassifier(self.HAARCASCADE))
 
     def model_detection(self, frame):
-        return self._cascade.detectMultiScale(
-            image=frame,
-            scaleFactor=self._scale_factor,
-            minNeighbors=self._min_neighbors,
-            minSize=self._min_size,
-            maxSize=self._max_size,
-        )
+        with self._cascade.borrow() as cascade:
+            return cascade.detectMultiScale(
+                image=frame,
+                scaleFactor=self._scale_factor,
+                minNeighbors=self._min_neighbors,
+                minSize=self._scaled_size(self._min_size),
+                maxSize=self._scaled_size(self._max_size),
+            )
+
+    def _scaled_size(self, size):
+        # Faces appear larger in a region of interest
+        zoom = self.roi_zoom()
+        return (int(size[0] * zoom), int(size[1] * zoom))
 
     def detection_post_process(self, detections):
-        processed_detections = [[
-            int(x * self._frame_scale_factor[0]),
-            int(y * self._frame_scale_factor[1]),
-            int(w * self._frame_scale_factor[0]),
-            int(h * self._frame_scale_factor[1]),] for (x, y, w, h) in detections]
-        return processed_detections, []
-
-    def get_frame(self):
-        frame = self._camera.read()
-
-        # Also convert to grayscale and equalize histogram
-        if frame is not None:
-            frame = cv2.resize(frame, self._det_frame_size, interpolation=cv2.INTER_AREA)
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            frame = cv2.equalizeHist(frame)
-
-        return frame
+        # detectMultiScale returns an empty tuple when nothing is found
+        boxes = np.asarray(detections, dtype=np.float32).reshape(-1, 4)
+        return Detections(boxes * self._frame_scale()), []
 
 
 class YuNetDetector(Detector):
     MODEL_PATH = 'trackstormsbot/models/face_detection_yunet_2022mar.onnx'
 
-    def __init__(self, camera, rate=-1, det_frame_size=(128, 96), score_threshold=0.7, nms_threshold=0.3, top_k=10):
-        super().__init__(camera, rate, det_frame_size)
+    def __init__(self,
+                 camera,
+                 rate=-1,
+                 det_frame_size=(128, 96),
+                 score_threshold=0.7,
+                 nms_threshold=0.3,
+                 top_k=10,
+                 dnn_backend='default',
+                 dnn_target='cpu',
+                 num_threads=None,
+                 model_pool=None):
+        super().__init__(camera, rate, det_frame_size, model_pool)
+        set_opencv_threads(num_threads)
         self._score_threshold = score_threshold
         self._nms_threshold = nms_threshold
         self._top_k = top_k
-        self._model = cv2.FaceDetectorYN.create(
-            self.MODEL_PATH,
-            '',
-            det_frame_size,
-            score_threshold,
-            nms_threshold,
-            top_k,
+        self._model = self.load_model(
+            (tuple(det_frame_size), score_threshold, nms_threshold, top_k, dnn_backend, dnn_target),
+            lambda: cv2.FaceDetectorYN.create(
+                self.MODEL_PATH,
+                '',
+                det_frame_size,
+                score_threshold,
+                nms_threshold,
+                top_k,
+                DNN_BACKENDS[dnn_backend],
+                DNN_TARGETS[dnn_target],
+            ),
         )
 
     def model_detection(self, frame):
-        return self._model.detect(frame)
+        with self._model.borrow() as model:
+            return model.detect(frame)
 
     def detection_post_process(self, detections):
-        processed_detections = []
-        for detection in (detections[1] if detections[1] is not None else []):
-            try:
-                x = int(detection[0] * self._frame_scale_factor[0])
-                y = int(detection[1] * self._frame_scale_factor[1])
-                w = int(detection[2] * self._frame_scale_factor[0])
-                h = int(detection[3] * self._frame_scale_factor[1])
-                processed_detections.append([x, y, w, h])
-            except Exception as e:
-                continue
+        # Rows of x, y, w, h, 5 landmark points (eyes, nose tip, mouth corners) and score
+        faces = detections[1]
+        if faces is None:
+            return Detections(), []
 
-        return processed_detections, []
+        return Detections(
+            boxes=faces[:, :4] * self._frame_scale(),
+            scores=faces[:, 14],
+            landmarks=faces[:, 4:14].reshape(-1, 5, 2) * self._frame_scale()[:2],
+        ), []
 
 
 class MediapipeDetector(Detector):
 
-    def __init__(self, camera, rate=-1, det_frame_size=(128, 96), score_threshold=0.7):
-        super().__init__(camera, rate, det_frame_size)
+    def __init__(self, camera, rate=-1, det_frame_size=(128, 96), score_threshold=0.7, model_pool=None):
+        super().__init__(camera, rate, det_frame_size, model_pool)
         self._score_threshold = score_threshold
 
+        # Only imported when this detector is used, it takes seconds on a Raspberry Pi
+        import mediapipe as mp
         mp_face_detection = mp.solutions.face_detection
-        self._model = mp_face_detection.FaceDetection(model='short', min_detection_confidence=self._score_threshold)
+        self._model = self.load_model(
+            (score_threshold,),
+            lambda: mp_face_detection.FaceDetection(model='short', min_detection_confidence=score_threshold),
+        )
 
     def model_detection(self, frame):
-        return self._model.process(frame)
+        with self._model.borrow() as model:
+            return model.process(frame)
 
     def detection_post_process(self, detections):
-        processed_detections = []
-        for detection in (detections.detections if detections.detections is not None else []):
-            x = int(detection.location_data.relative_bounding_box.xmin * self._det_frame_size[0] *
-                    self._frame_scale_factor[0])
-            y = int(detection.location_data.relative_bounding_box.ymin * self._det_frame_size[1] *
-                    self._frame_scale_factor[1])
-            w = int(detection.location_data.relative_bounding_box.width * self._det_frame_size[0] *
-                    self._frame_scale_factor[0])
-            h = int(detection.location_data.relative_bounding_box.height * self._det_frame_size[1] *
-                    self._frame_scale_factor[1])
-            processed_detections.append([x, y, w, h])
-
-        return processed_detections, []
+        if detections.detections is None:
+            return Detections(), []
+
+        # Gather the relative coordinates once, then scale them to the camera frame in one go
+        locations = [detection.location_data for detection in detections.detections]
+        relative_boxes = [(box.xmin, box.ymin, box.width, box.height)
+                          for box in (location.relative_bounding_box for location in locations)]
+        relative_keypoints = [[(keypoint.x, keypoint.y) for keypoint in location.relative_keypoints]
+                              for location in locations]
+        frame_size = np.array(self._camera_frame_size * 2, dtype=np.float32)
+
+        return Detections(
+            boxes=np.array(relative_boxes, dtype=np.float32) * frame_size,
+            scores=[detection.score[0] for detection in detections.detections],
+            landmarks=np.array(relative_keypoints, dtype=np.float32) * frame_size[:2],
+        ), []
+
+
+DETECTOR_MAP = {
+    'haarcascade': CascadeDetector,
+    'yunet': YuNetDetector,
+    'mediapipe': MediapipeDetector,}
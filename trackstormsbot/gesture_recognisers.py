@@ -1,7 +1,8 @@
-import mediapipe as mp
+from collections import Counter, deque
+
 import numpy as np
-import tflite_runtime.interpreter as tflite
 
+from trackstormsbot.detections import Detections
 from trackstormsbot.detectors import Detector
 
 
@@ -14,77 +15,155 @@ class KeyPointClassifier:
         self,
         model_path='model/keypoint_classifier.tflite',
         num_threads=1,
+        max_batch_size=1,
     ):
+        import tflite_runtime.interpreter as tflite
         self.interpreter = tflite.Interpreter(model_path=model_path, num_threads=num_threads)
 
         self.interpreter.allocate_tensors()
         self.input_details = self.interpreter.get_input_details()
         self.output_details = self.interpreter.get_output_details()
 
+        # Looked up once instead of on every invocation
+        self._input_index = self.input_details[0]['index']
+        self._output_index = self.output_details[0]['index']
+        self._input_size = self.input_details[0]['shape'][-1]
+        self._batch_size = 1
+        self._input = None
+        self._resize(max_batch_size)
+
+    def _resize(self, batch_size):
+        # Reallocating the interpreter is slow, so only grow when more hands show up than ever before
+        if batch_size != self._batch_size:
+            self.interpreter.resize_tensor_input(self._input_index, [batch_size, self._input_size])
+            self.interpreter.allocate_tensors()
+            self._batch_size = batch_size
+        # The first two values are the wrist, which is the origin of the relative landmarks and always zero
+        self._input = np.zeros((batch_size, self._input_size), dtype=np.float32)
+
     def __call__(
         self,
         landmark_list,
     ):
-        input_details_tensor_index = self.input_details[0]['index']
-        landmark_list = [0, 0] + landmark_list  # add 2 zeros for base point
-        self.interpreter.set_tensor(input_details_tensor_index, np.array([landmark_list], dtype=np.float32))
+        return self.classify(np.asarray(landmark_list, dtype=np.float32)[np.newaxis])[0]
+
+    def classify(self, landmark_batch):
+        # Classifies (hands, 40) preprocessed landmarks in a single invocation
+        count = len(landmark_batch)
+        if count > self._batch_size:
+            self._resize(count)
+
+        self._input[:count, 2:] = landmark_batch
+        self._input[count:, 2:] = 0
+        self.interpreter.set_tensor(self._input_index, self._input)
         self.interpreter.invoke()
 
-        output_details_tensor_index = self.output_details[0]['index']
+        # tensor() returns a view on the interpreter memory, only valid until the next invocation
+        result = self.interpreter.tensor(self._output_index)()
+        return np.argmax(result[:count], axis=1)
+
 
-        result = self.interpreter.get_tensor(output_details_tensor_index)
+class GestureVoter:
+    # Majority vote over the most recent labels, so a single misclassified frame does not flip the gesture
 
-        result_index = np.argmax(np.squeeze(result))
+    def __init__(self, window=5, min_votes=None):
+        self._labels = deque(maxlen=window)
+        self._min_votes = window // 2 + 1 if min_votes is None else min_votes
+        self._label = 'None'
 
-        return result_index
+    def __call__(self, label):
+        self._labels.append(label)
+        candidate, votes = Counter(self._labels).most_common(1)[0]
+        if votes >= self._min_votes:
+            self._label = candidate
+        return self._label
 
 
 class MediapipeRecogniser(Detector):
     KEYPOINT_CLASSIFIER_PATH = 'trackstormsbot/models/keypoint_classifier.tflite'
     GESTURE_LABELS = ['open', 'close', 'point']
 
-    def __init__(self, camera, rate=-1, det_frame_size=(128, 96), score_threshold=0.7):
-        super().__init__(camera, rate, det_frame_size)
+    def __init__(self,
+                 camera,
+                 rate=-1,
+                 det_frame_size=(128, 96),
+                 score_threshold=0.7,
+                 max_num_hands=1,
+                 num_threads=1,
+                 smoothing_window=1,
+                 static_image_mode=False,
+                 model_pool=None):
+        super().__init__(camera, rate, det_frame_size, model_pool)
         self._score_threshold = score_threshold
+
+        # Only imported when gestures are recognised, it takes seconds on a Raspberry Pi
+        import mediapipe as mp
         mp_hands = mp.solutions.hands
-        self._model = mp_hands.Hands(
-            max_num_hands=1,
-            model_complexity=0,
-            min_detection_confidence=self._score_threshold,
-            min_tracking_confidence=self._score_threshold,
+        # Hands tracks landmarks from the previous frame, which belongs to another camera when the model is shared
+        # and to another crop when the caller hands it regions of interest
+        static_image_mode = static_image_mode or model_pool is not None
+        self._model = self.load_model(
+            (max_num_hands, score_threshold, static_image_mode),
+            lambda: mp_hands.Hands(
+                static_image_mode=static_image_mode,
+                max_num_hands=max_num_hands,
+                model_complexity=0,
+                min_detection_confidence=score_threshold,
+                min_tracking_confidence=score_threshold,
+            ),
         )
-        self._classifier = KeyPointClassifier(model_path=self.KEYPOINT_CLASSIFIER_PATH)
+        self._classifier = self.load_model(
+            (self.KEYPOINT_CLASSIFIER_PATH, num_threads, max_num_hands),
+            lambda: KeyPointClassifier(
+                model_path=self.KEYPOINT_CLASSIFIER_PATH,
+                num_threads=num_threads,
+                max_batch_size=max_num_hands,
+            ),
+        )
+        self._voter = GestureVoter(smoothing_window) if smoothing_window > 1 else None
+        self._hand_gestures = []
 
     def model_detection(self, frame):
-        return self._model.process(frame)
+        with self._model.borrow() as model:
+            return model.process(frame)
 
     def detection_post_process(self, detections):
-        landmarks = []
-        for hand_landmarks in (detections.multi_hand_landmarks if detections.multi_hand_landmarks is not None else []):
-            for landmark in hand_landmarks.landmark:
-                landmarks.append((int(landmark.x * self._det_frame_size[0] * self._frame_scale_factor[0]),
-                                  int(landmark.y * self._det_frame_size[1] * self._frame_scale_factor[1])))
+        if detections.multi_hand_landmarks is None:
+            self._hand_gestures = []
+            return Detections(landmarks=[]), self._vote(self._get_gesture_label(-1))
+
+        # (hands, 21, 2) landmarks scaled to the camera frame in one go
+        relative_landmarks = [[(landmark.x, landmark.y) for landmark in hand_landmarks.landmark]
+                              for hand_landmarks in detections.multi_hand_landmarks]
+        landmarks = np.array(relative_landmarks, dtype=np.float32) * np.array(self._camera_frame_size, dtype=np.float32)
+        boxes = np.concatenate((landmarks.min(axis=1), landmarks.max(axis=1) - landmarks.min(axis=1)), axis=1)
+
+        # All hands in one invocation, the first (most prominent) hand decides the gesture
+        with self._classifier.borrow() as classifier:
+            gestures = classifier.classify(self._preprocess_landmarks(landmarks))
+        self._hand_gestures = [self._get_gesture_label(gesture) for gesture in gestures]
+
+        return Detections(boxes=boxes, landmarks=landmarks), self._vote(self._hand_gestures[0])
+
+    def warm_up(self, iterations=2):
+        # A blank frame has no hands, so also run the classifier once
+        super().warm_up(iterations)
+        with self._classifier.borrow() as classifier:
+            classifier.classify(np.zeros((1, 40), dtype=np.float32))
 
-        gesture = -1
-        if len(landmarks) > 0:
-            processed_landmarks = self._preprocess_landmarks(landmarks)
-            gesture = self._classifier(processed_landmarks)
+    def hand_gestures(self):
+        # Unsmoothed labels of every hand in the last processed frame
+        return self._hand_gestures
 
-        return (landmarks, self._get_gesture_label(gesture))
+    def _vote(self, label):
+        return label if self._voter is None else self._voter(label)
 
     def _preprocess_landmarks(self, landmarks):
-        processed_landmarks = []
-        if len(landmarks) > 0:
-            base_x, base_y = landmarks[0]
-            for x, y in landmarks[1:]:
-                processed_landmarks.append(x - base_x)
-                processed_landmarks.append(y - base_y)
-
-        # normalize list
-        max_value = max(list(map(abs, processed_landmarks)))
-        processed_landmarks = list(map(lambda x: x / max_value, processed_landmarks))
-
-        return processed_landmarks
+        # Integer pixel coordinates relative to the wrist, normalised per hand by the largest absolute value
+        landmarks = landmarks.astype(np.int32)
+        processed_landmarks = (landmarks[:, 1:] - landmarks[:, :1]).reshape(len(landmarks), -1).astype(np.float32)
+        max_values = np.abs(processed_landmarks).max(axis=1, keepdims=True)
+        return processed_landmarks / np.where(max_values > 0, max_values, 1)
 
     def _get_gesture_label(self, gesture):
         return self.GESTURE_LABELS[gesture] if gesture >= 0 else 'None'
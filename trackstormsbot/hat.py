@@ -0,0 +1,128 @@
+import logging
+import time
+from collections import OrderedDict
+from threading import Condition, Thread
+
+from trackstormsbot.metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+
+class _Poller:
+
+    def __init__(self, function, rate):
+        self.function = function
+        self.period = 1 / rate
+        self.next_time = 0
+        self.value = None
+
+
+class BuildHatWorker:
+    # Owns the serial link to the Build HAT, so the control and video threads never wait on a round trip.
+    # Queued commands with the same key replace each other, only the latest one is sent
+
+    def __init__(self):
+        self._pending = OrderedDict()
+        self._pollers = {}
+        self._latency = {}
+        self._sent = 0
+        self._coalesced = 0
+        self._stopped = False
+        self._condition = Condition()
+        self._thread = None
+        self._users = 0
+
+    def start(self):
+        # Shared by the rigs on one HAT, the worker runs until the last of them stops it
+        with self._condition:
+            self._users += 1
+            if self._users > 1:
+                return
+        self._stopped = False
+        self._thread = Thread(target=self.run, args=(), daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        # Commands still queued (e.g. stopping the motors) are sent before the worker exits
+        with self._condition:
+            self._users = max(0, self._users - 1)
+            if self._users > 0:
+                return
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, key, function, *args):
+        # key is (command, device), e.g. ('pwm', 'A')
+        with self._condition:
+            if key in self._pending:
+                del self._pending[key]
+                self._coalesced += 1
+            self._pending[key] = (function, args)
+            self._condition.notify()
+
+    def poll(self, name, function, rate):
+        # Call function at rate in the background, the last result is available through value().
+        # A rate of 0 or less disables polling and value() stays None
+        if rate <= 0:
+            return
+        with self._condition:
+            self._pollers[name] = _Poller(function, rate)
+            self._condition.notify()
+
+    def value(self, name):
+        poller = self._pollers.get(name)
+        return None if poller is None else poller.value
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    timeout = self._poll_timeout()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                if self._stopped and not self._pending:
+                    return
+                commands = list(self._pending.items())
+                self._pending.clear()
+                pollers = list(self._pollers.items())
+
+            for (command, _), (function, args) in commands:
+                self._call(command, function, *args)
+
+            now = time.perf_counter()
+            for name, poller in pollers:
+                if now >= poller.next_time:
+                    poller.next_time = now + poller.period
+                    poller.value = self._call(name, poller.function)
+
+    def _poll_timeout(self):
+        if not self._pollers:
+            return None
+        return min(poller.next_time for poller in self._pollers.values()) - time.perf_counter()
+
+    def _call(self, command, function, *args):
+        start_time = time.perf_counter()
+        try:
+            return function(*args)
+        except Exception:
+            log.exception(f'Build HAT command {command} failed')
+            return None
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self._latency[command] = 0.9 * self._latency.get(command, elapsed) + 0.1 * elapsed
+            self._sent += 1
+            REGISTRY.observe('hat_command', elapsed, command=command)
+
+    def latency(self, command):
+        return self._latency.get(command, 0) * 1000
+
+    def coalesced(self):
+        return self._coalesced
+
+    def stats(self):
+        return {
+            'HAT ms': ' '.join(f'{command} {latency * 1000:.1f}' for command, latency in sorted(self._latency.items())),
+            'HAT sent/coalesced': f'{self._sent}/{self._coalesced}',}
@@ -0,0 +1,145 @@
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LatencySummary:
+
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._sum = 0
+        self._count = 0
+        self._lock = Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._sum += seconds
+            self._count += 1
+
+    def quantiles(self, quantiles=QUANTILES):
+        # Over the most recent window of samples
+        with self._lock:
+            samples = np.array(self._samples)
+        if len(samples) == 0:
+            return {q: float('nan') for q in quantiles}
+        return dict(zip(quantiles, np.quantile(samples, quantiles)))
+
+    def sum(self):
+        return self._sum
+
+    def count(self):
+        return self._count
+
+
+class MetricsRegistry:
+
+    def __init__(self, prefix='trackstormsbot'):
+        self._prefix = prefix
+        self._summaries = {}
+        self._gauges = {}
+        self._counters = {}
+        self._lock = Lock()
+
+    def summary(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._summaries:
+                self._summaries[key] = LatencySummary()
+            return self._summaries[key]
+
+    def observe(self, name, seconds, **labels):
+        self.summary(name, **labels).observe(seconds)
+
+    def set_gauge(self, name, value, **labels):
+        self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def counter(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def quantiles(self, name, **labels):
+        return self.summary(name, **labels).quantiles()
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self._lock:
+            summaries = sorted(self._summaries.items())
+            gauges = sorted(self._gauges.items())
+            counters = sorted(self._counters.items())
+
+        declared = set()
+        for (name, labels), summary in summaries:
+            metric = f'{self._prefix}_{name}_seconds'
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} summary')
+                declared.add(metric)
+            for quantile, value in summary.quantiles().items():
+                lines.append(f'{metric}{_format_labels(labels + (("quantile", quantile),))} {value}')
+            lines.append(f'{metric}_sum{_format_labels(labels)} {summary.sum()}')
+            lines.append(f'{metric}_count{_format_labels(labels)} {summary.count()}')
+
+        for (name, labels), value in gauges:
+            metric = f'{self._prefix}_{name}'
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} gauge')
+                declared.add(metric)
+            lines.append(f'{metric}{_format_labels(labels)} {value}')
+
+        for (name, labels), value in counters:
+            metric = f'{self._prefix}_{name}_total'
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} counter')
+                declared.add(metric)
+            lines.append(f'{metric}{_format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class StartupTimer:
+    # Wall time of each startup phase, logged and exported as the startup_seconds gauge
+
+    def __init__(self, start_time=None, registry=None):
+        self._start_time = time.perf_counter() if start_time is None else start_time
+        self._registry = registry
+        self._phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_time)
+
+    def record(self, name, seconds):
+        self._phases[name] = seconds
+        (self._registry or REGISTRY).set_gauge('startup_seconds', seconds, phase=name)
+        log.info(f'Startup {name}: {seconds * 1000:.0f} ms')
+
+    def finish(self):
+        # Everything since start_time, including what happened outside the phases
+        self.record('total', time.perf_counter() - self._start_time)
+        return dict(self._phases)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,33 @@
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    # Cheap change detection on a small grayscale thumbnail of the frame, each pixel the mean of a block.
+    # A frame is static when few blocks changed since the last frame that was actually processed
+
+    def __init__(self, cache, threshold=8, min_changed=0.01, max_reuse_age=1.0, size=(32, 24)):
+        self._cache = cache
+        self._threshold = threshold
+        self._min_changed = min_changed
+        self._max_reuse_age = max_reuse_age
+        self._size = size
+        self._reference = None
+        self._reference_time = 0
+
+    def is_static(self, frame):
+        thumbnail = self._cache.get(frame, self._size, cv2.INTER_AREA, 'gray').astype(np.int16)
+
+        # Results are refreshed at least every max_reuse_age seconds, in case the change was too subtle
+        static = self._reference is not None and frame.timestamp - self._reference_time < self._max_reuse_age
+        if static:
+            changed = (np.abs(thumbnail - self._reference) > self._threshold).mean()
+            static = changed < self._min_changed
+
+        if not static:
+            self._reference = thumbnail
+            self._reference_time = frame.timestamp
+        return static
+
+    def reset(self):
+        self._reference = None
@@ -0,0 +1,96 @@
+import numpy as np
+
+from trackstormsbot.detections import Detections
+from trackstormsbot.detectors import Detector
+
+
+class FusedPerception(Detector):
+    # Face detection and gesture recognition on the same frame: hands are searched in a window around and below
+    # the face, or in the full frame every full_frame_interval frames while there is no face.
+    # Results are (faces, (hands, gesture)), all from one frame. The gesture recogniser is handed crops in a
+    # different place on every frame, so it needs to run in static image mode
+
+    def __init__(self,
+                 camera,
+                 face_detector,
+                 gesture_recogniser,
+                 rate=-1,
+                 hand_region=(4.0, 4.0),
+                 full_frame_interval=5):
+        # The wrapped detectors only process frames handed to them and are never started themselves
+        super().__init__(camera, rate, face_detector.det_frame_size())
+        self._face_detector = face_detector
+        self._gesture_recogniser = gesture_recogniser
+        self._hand_region = hand_region
+        self._full_frame_interval = full_frame_interval
+        self._hands = Detections(landmarks=[])
+        self._gesture = 'None'
+        self._result = self._result._replace(labels=(self._hands, self._gesture))
+        self._since_hand_search = full_frame_interval
+        self._hand_roi_frames = 0
+
+    def warm_up(self, iterations=2):
+        self._face_detector.warm_up(iterations)
+        self._gesture_recogniser.warm_up(iterations)
+
+    def get_frame(self):
+        # Keep the full frame, both detectors preprocess it to their own size
+        return self.next_frame()
+
+    def process(self, frame):
+        faces, _ = self._face_detector.process(self._face_detector.preprocess(frame))
+        faces = self._face_detector.update_roi(faces)
+
+        if len(faces) > 0:
+            self._hand_roi_frames += 1
+            self._recognise(frame, self._hand_roi(faces.box(faces.best())))
+        elif self._since_hand_search >= self._full_frame_interval:
+            self._recognise(frame, None)
+        else:
+            # No hand search on this frame, hands from an earlier frame would not belong with these faces
+            self._hands = Detections(landmarks=[]).stamped(frame.seq, frame.timestamp)
+            self._gesture = 'None'
+            self._since_hand_search += 1
+
+        return faces, (self._hands, self._gesture)
+
+    def _recognise(self, frame, roi):
+        recogniser = self._gesture_recogniser
+        hands, gesture = recogniser.process(recogniser.preprocess(frame, roi))
+        self._hands = recogniser.update_roi(hands).stamped(frame.seq, frame.timestamp)
+        self._gesture = gesture
+        self._since_hand_search = 0
+
+    def _hand_roi(self, face):
+        # Window centred on the face horizontally and reaching down from just above it, with the aspect ratio
+        # of the recogniser so the crop is not distorted
+        x, y, w, h = face
+        frame_w, frame_h = self._camera_frame_size
+        det_w, det_h = self._gesture_recogniser.det_frame_size()
+        aspect = det_w / det_h
+
+        roi_h = max(h * self._hand_region[1], w * self._hand_region[0] / aspect, det_h)
+        roi_h = min(roi_h, frame_h, frame_w / aspect)
+        roi_w = int(roi_h * aspect)
+        roi_h = int(roi_h)
+        if roi_w >= frame_w and roi_h >= frame_h:
+            return None
+
+        roi_x = int(np.clip(x + w / 2 - roi_w / 2, 0, frame_w - roi_w))
+        roi_y = int(np.clip(y - h / 2, 0, frame_h - roi_h))
+        return roi_x, roi_y, roi_w, roi_h
+
+    def gesture_recogniser(self):
+        return self._gesture_recogniser
+
+    def preprocess_time(self):
+        return self._face_detector.preprocess_time()
+
+    def stats(self):
+        # The face detector never counts the frames it is handed, so its ratios are over the fused frame count
+        stats = super().stats()
+        roi_ratio = self._face_detector.roi_ratio(self._processed_frames)
+        if roi_ratio is not None:
+            stats['ROI ratio'] = f'{roi_ratio:.2f}'
+        stats['Hand ROI ratio'] = f'{self._hand_roi_frames / max(1, self._processed_frames):.2f}'
+        return stats
@@ -0,0 +1,89 @@
+import logging
+import time
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+log = logging.getLogger(__name__)
+
+
+class PooledModel:
+    # Instances of one model configuration, lent to one detector at a time. The first instance is loaded right
+    # away, more are only loaded when detectors actually need it at the same time, up to max_instances
+
+    def __init__(self, factory, max_instances=1):
+        self._factory = factory
+        self._max_instances = max_instances
+        self._idle = [factory()]
+        self._instances = 1
+        self._users = 0
+        self._borrowed = 0
+        self._wait_time = 0
+        self._condition = Condition()
+
+    def add_user(self):
+        with self._condition:
+            self._users += 1
+
+    @contextmanager
+    def borrow(self):
+        start_time = time.perf_counter()
+        with self._condition:
+            self._condition.wait_for(lambda: self._idle or self._instances < self._max_instances)
+            model = self._idle.pop() if self._idle else None
+            if model is None:
+                self._instances += 1
+            self._borrowed += 1
+            self._wait_time = 0.9 * self._wait_time + 0.1 * (time.perf_counter() - start_time)
+
+        if model is None:
+            log.info(f'Loading instance {self._instances} of a shared model')
+            try:
+                model = self._factory()
+            except Exception:
+                with self._condition:
+                    self._instances -= 1
+                    self._condition.notify()
+                raise
+
+        try:
+            yield model
+        finally:
+            with self._condition:
+                self._idle.append(model)
+                self._condition.notify()
+
+    def instances(self):
+        return self._instances
+
+    def users(self):
+        return self._users
+
+    def wait_time(self):
+        # Smoothed time a detector waited for an instance in milliseconds
+        return self._wait_time * 1000
+
+
+class ModelPool:
+    # Models shared by the detectors of every rig, keyed by detector class and model configuration,
+    # so adding a rig does not load another copy of each model
+
+    def __init__(self, max_instances=1):
+        self._max_instances = max_instances
+        self._models = {}
+        self._lock = Lock()
+
+    def get(self, key, factory):
+        with self._lock:
+            if key not in self._models:
+                self._models[key] = PooledModel(factory, self._max_instances)
+            model = self._models[key]
+        model.add_user()
+        return model
+
+    def stats(self):
+        with self._lock:
+            models = list(self._models.values())
+        instances = sum(model.instances() for model in models)
+        users = sum(model.users() for model in models)
+        wait_time = max((model.wait_time() for model in models), default=0)
+        return {'Models loaded / users': f'{instances} / {users}', 'Model wait ms (max)': f'{wait_time:.1f}'}
@@ -0,0 +1,112 @@
+import time
+from threading import Event, Lock
+
+import cv2
+
+COLOR_TRANSFORMS = {
+    'bgr': None,
+    'rgb': lambda frame: cv2.cvtColor(frame, cv2.COLOR_BGR2RGB),
+    'gray': lambda frame: cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+    'gray_eq': lambda frame: cv2.equalizeHist(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)),}
+
+
+class _CacheEntry:
+
+    def __init__(self):
+        self.image = None
+        self.error = None
+        self.ready = Event()
+
+
+class PreprocessCache:
+
+    def __init__(self, keep_frames=2):
+        self._keep_frames = keep_frames
+        self._entries = {}
+        self._latest_seq = 0
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._compute_time = 0
+
+    def get(self, frame, size, interpolation=cv2.INTER_AREA, transform='bgr', roi=None):
+        if transform not in COLOR_TRANSFORMS:
+            raise ValueError(f'Unknown colour transform {transform}')
+
+        key = (frame.seq, tuple(size), interpolation, transform, roi)
+        with self._lock:
+            if frame.seq > self._latest_seq:
+                self._latest_seq = frame.seq
+                self._evict()
+
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = _CacheEntry()
+                self._entries[key] = entry
+                self._misses += 1
+            else:
+                self._hits += 1
+
+        # The first consumer computes the image, concurrent consumers of the same key wait for it
+        if owner:
+            try:
+                entry.image = self._compute(frame, size, interpolation, transform, roi)
+            except Exception as error:
+                # Consumers already waiting get the error too, later ones try again
+                entry.error = error
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+                raise
+            finally:
+                entry.ready.set()
+        else:
+            entry.ready.wait()
+            if entry.error is not None:
+                raise entry.error
+
+        return entry.image
+
+    def put(self, frame, size, image, interpolation=cv2.INTER_AREA, transform='bgr'):
+        # Seed the cache with an image produced elsewhere, e.g. a low resolution camera stream
+        entry = _CacheEntry()
+        image.setflags(write=False)
+        entry.image = image
+        entry.ready.set()
+        with self._lock:
+            self._entries[(frame.seq, tuple(size), interpolation, transform, None)] = entry
+
+    def _compute(self, frame, size, interpolation, transform, roi):
+        # Colour transforms are applied on the (shared) resized frame
+        if transform != 'bgr':
+            image = self.get(frame, size, interpolation, 'bgr', roi)
+        elif roi is not None:
+            # Crop the (x, y, w, h) region of interest, a view of the frame so no copy is made
+            x, y, w, h = roi
+            image = frame.image[y:y + h, x:x + w]
+        elif tuple(size) != (frame.image.shape[1], frame.image.shape[0]):
+            image = frame.image
+        else:
+            return frame.image
+
+        start_time = time.perf_counter()
+        if transform == 'bgr':
+            image = cv2.resize(image, tuple(size), interpolation=interpolation)
+        else:
+            image = COLOR_TRANSFORMS[transform](image)
+        self._compute_time += time.perf_counter() - start_time
+
+        image.setflags(write=False)
+        return image
+
+    def _evict(self):
+        min_seq = self._latest_seq - self._keep_frames
+        for key in [key for key in self._entries if key[0] <= min_seq]:
+            del self._entries[key]
+
+    def stats(self):
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'compute_time': self._compute_time,}
@@ -0,0 +1,270 @@
+import json
+import logging
+import os
+import struct
+import time
+from collections import deque
+from threading import Condition, Thread
+
+import cv2
+import numpy as np
+
+from trackstormsbot.camera import Frame
+from trackstormsbot.detections import Detections
+from trackstormsbot.sources import FileSource
+
+log = logging.getLogger(__name__)
+
+# Record kinds in the session log
+FRAME = 1
+FACES = 2
+HANDS = 3
+DISTANCE = 4
+PWM = 5
+
+# Kind, frame seq, frame capture time, seconds from capture until the record was made, payload size
+HEADER = struct.Struct('<BIdfH')
+
+META_FILE = 'session.json'
+LOG_FILE = 'session.log'
+VIDEO_FILE = 'video.avi'
+FRAMES_DIR = 'frames'
+
+
+def _pack_boxes(detections, with_scores):
+    values = np.concatenate((detections.boxes, detections.scores[:, None]), axis=1) if with_scores else \
+        detections.boxes
+    return struct.pack('<H', len(detections)) + values.astype('<f4').tobytes()
+
+
+def _unpack_boxes(payload, columns):
+    count, = struct.unpack_from('<H', payload)
+    end = 2 + count * columns * 4
+    values = np.frombuffer(payload[2:end], dtype='<f4').reshape(count, columns)
+    return values, payload[end:]
+
+
+class SessionRecorder:
+    # Camera frames and a compact binary log of what the bot saw and did, keyed by frame seq and capture time.
+    # Callers only queue, one thread collects frames from the camera and another writes in bulk. When the disk
+    # can't keep up frames are dropped, the log records have a much larger queue of their own
+    VIDEO_FORMATS = ['mjpg', 'png', 'none']
+
+    def __init__(self,
+                 path,
+                 frame_reader,
+                 frame_size,
+                 fps=30,
+                 video='mjpg',
+                 max_queued_frames=8,
+                 max_queued_records=10000,
+                 flush_interval=0.5):
+        self._path = path
+        self._frame_reader = frame_reader
+        self._frame_size = tuple(frame_size)
+        self._fps = fps
+        self._video = video
+        self._max_queued_frames = max_queued_frames
+        self._max_queued_records = max_queued_records
+        self._flush_interval = flush_interval
+        self._frames = deque()
+        self._records = deque()
+        self._condition = Condition()
+        self._stopped = False
+        self._start_time = None
+        self._frame_count = 0
+        self._dropped_frames = 0
+        self._dropped_records = 0
+        self._bytes_written = 0
+        self._writer = None
+        self._log_file = None
+        self._collect_thread = Thread(target=self.collect, args=(), daemon=True)
+        self._write_thread = Thread(target=self.write, args=(), daemon=True)
+
+    def start(self):
+        os.makedirs(self._path, exist_ok=True)
+        if self._video == 'png':
+            os.makedirs(os.path.join(self._path, FRAMES_DIR), exist_ok=True)
+        elif self._video == 'mjpg':
+            self._writer = cv2.VideoWriter(os.path.join(self._path, VIDEO_FILE), cv2.VideoWriter_fourcc(*'MJPG'),
+                                           self._fps, self._frame_size)
+        self._start_time = time.time()
+        meta = {'frame_size': self._frame_size, 'fps': self._fps, 'video': self._video, 'start_time': self._start_time}
+        with open(os.path.join(self._path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+        self._log_file = open(os.path.join(self._path, LOG_FILE), 'wb')
+
+        self._stopped = False
+        self._write_thread.start()
+        if self._video != 'none':
+            self._collect_thread.start()
+        log.info(f'Recording session to {self._path}')
+
+    def stop(self):
+        # Everything queued so far is still written
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._collect_thread.is_alive():
+            self._collect_thread.join()
+        if self._write_thread.is_alive():
+            self._write_thread.join()
+
+    def collect(self):
+        while not self._stopped:
+            frame = self._frame_reader.next(timeout=1.0)
+            if frame is None:
+                if self._frame_reader.closed():
+                    # The camera is gone, next() would return straight away and spin
+                    break
+                continue
+            with self._condition:
+                if len(self._frames) >= self._max_queued_frames:
+                    self._dropped_frames += 1
+                    continue
+                self._frames.append(frame)
+                self._condition.notify()
+
+    def record(self, kind, seq, timestamp, payload=b''):
+        # Packed right away, so the writer only has to join the records. Records made before the first frame
+        # was processed have no seq and carry their own time
+        now = time.time()
+        timestamp = now if timestamp is None else timestamp
+        record = HEADER.pack(kind, seq or 0, timestamp, now - timestamp, len(payload)) + payload
+        with self._condition:
+            if len(self._records) >= self._max_queued_records:
+                self._dropped_records += 1
+                return
+            self._records.append(record)
+
+    def record_faces(self, detections):
+        self.record(FACES, detections.seq, detections.timestamp, _pack_boxes(detections, True))
+
+    def record_hands(self, hands, gesture):
+        self.record(HANDS, hands.seq, hands.timestamp, _pack_boxes(hands, False) + gesture.encode())
+
+    def record_distance(self, seq, timestamp, distance):
+        self.record(DISTANCE, seq, timestamp, struct.pack('<f', distance))
+
+    def record_pwm(self, seq, timestamp, pwm):
+        self.record(PWM, seq, timestamp, struct.pack('<2f', *pwm))
+
+    def write(self):
+        try:
+            while True:
+                with self._condition:
+                    # Wait for a frame or a batch of records worth writing
+                    self._condition.wait_for(lambda: self._stopped or self._frames, self._flush_interval)
+                    records = list(self._records)
+                    self._records.clear()
+                    frames = list(self._frames)
+                    self._frames.clear()
+                    stopped = self._stopped
+
+                # The log first, it is small and worth more than the video
+                self._write_records(records)
+                self._write_records([self._write_frame(frame) for frame in frames])
+                if stopped and not self._frames:
+                    break
+        finally:
+            self._close()
+
+    def _write_records(self, records):
+        if records:
+            data = b''.join(records)
+            self._log_file.write(data)
+            self._bytes_written += len(data)
+
+    def _write_frame(self, frame):
+        # Returns the record of where the frame went in the video
+        if self._writer is not None:
+            self._writer.write(frame.image)
+        else:
+            cv2.imwrite(os.path.join(self._path, FRAMES_DIR, f'{self._frame_count:08d}.png'), frame.image)
+        record = HEADER.pack(FRAME, frame.seq, frame.timestamp, 0, 4) + struct.pack('<I', self._frame_count)
+        self._frame_count += 1
+        return record
+
+    def _close(self):
+        self._log_file.close()
+        if self._writer is not None:
+            self._writer.release()
+        log.info(f'Recorded {self._frame_count} frames to {self._path}, dropped {self._dropped_frames} frames '
+                 f'and {self._dropped_records} log records')
+
+    def stats(self):
+        dropped = self._dropped_frames + self._frame_reader.skipped()
+        return {
+            'Recorder frames / dropped': f'{self._frame_count} / {dropped}',
+            'Recorder log kB': self._bytes_written // 1024,}
+
+
+def is_session(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+class SessionReader:
+    # Reads a recorded session back in recording order
+
+    def __init__(self, path):
+        self._path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self._meta = json.load(f)
+
+    def frame_size(self):
+        return tuple(self._meta['frame_size'])
+
+    def fps(self):
+        return self._meta['fps']
+
+    def records(self, kinds=None):
+        # (kind, seq, timestamp, delay, value) with the value decoded by kind
+        with open(os.path.join(self._path, LOG_FILE), 'rb') as f:
+            data = f.read()
+
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            kind, seq, timestamp, delay, size = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            payload = data[offset:offset + size]
+            offset += size
+            if len(payload) < size:
+                # Cut short when the bot was killed while writing
+                break
+            if kinds is None or kind in kinds:
+                yield kind, seq, timestamp, delay, self._decode(kind, seq, timestamp, payload)
+
+    def _decode(self, kind, seq, timestamp, payload):
+        if kind == FRAME:
+            return struct.unpack('<I', payload)[0]
+        if kind == FACES:
+            values, _ = _unpack_boxes(payload, 5)
+            return Detections(values[:, :4], values[:, 4], seq=seq, timestamp=timestamp)
+        if kind == HANDS:
+            values, gesture = _unpack_boxes(payload, 4)
+            return Detections(values, seq=seq, timestamp=timestamp), gesture.decode()
+        if kind == DISTANCE:
+            return struct.unpack('<f', payload)[0]
+        if kind == PWM:
+            return struct.unpack('<2f', payload)
+        raise ValueError(f'Unknown record kind {kind}')
+
+    def video_path(self):
+        if self._meta['video'] == 'mjpg':
+            return os.path.join(self._path, VIDEO_FILE)
+        if self._meta['video'] == 'png':
+            return os.path.join(self._path, FRAMES_DIR)
+        return None
+
+    def frames(self):
+        # Recorded frames with their original seq and capture time
+        video_path = self.video_path()
+        if video_path is None:
+            return
+        source = FileSource(video_path, self.frame_size(), loop=False, realtime=False)
+        images = source.frames()
+        for _, seq, timestamp, _, _ in self.records({FRAME}):
+            image = next(images, None)
+            if image is None:
+                return
+            yield Frame(image, seq, timestamp)
@@ -0,0 +1,129 @@
+import logging
+import os
+import time
+from threading import Condition
+
+log = logging.getLogger(__name__)
+
+
+class PressureMonitor:
+    THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'
+
+    def __init__(self, soft_temp=70, hard_temp=80, interval=1.0):
+        self._soft_temp = soft_temp
+        self._hard_temp = hard_temp
+        self._interval = interval
+        self._last_sample = 0
+        self._pressure = 0
+        self._temperature = None
+
+    def temperature(self):
+        try:
+            with open(self.THERMAL_ZONE) as f:
+                return int(f.read()) / 1000
+        except (OSError, ValueError):
+            return None
+
+    def pressure(self):
+        # 0 when there is headroom, 1 when the Pi is at its thermal limit or the CPU is fully loaded
+        if time.time() - self._last_sample < self._interval:
+            return self._pressure
+        self._last_sample = time.time()
+
+        self._temperature = self.temperature()
+        thermal = 0
+        if self._temperature is not None:
+            thermal = (self._temperature - self._soft_temp) / (self._hard_temp - self._soft_temp)
+        load = os.getloadavg()[0] / os.cpu_count() - 1
+        self._pressure = min(1, max(0, thermal, load))
+        return self._pressure
+
+
+class _Entry:
+
+    def __init__(self, rate, priority):
+        self.rate = rate
+        self.priority = priority
+        self.effective_rate = rate
+        self.next_time = 0
+        self.waiting = False
+        self.wait_start = 0
+
+    def effective_priority(self, now, aging_time):
+        # Waiting detectors slowly gain priority so low priority ones are never starved completely
+        return self.priority + (now - self.wait_start) / aging_time
+
+
+class DetectorScheduler:
+
+    def __init__(self, max_concurrent=None, min_rate_scale=0.25, aging_time=1.0, pressure_monitor=None):
+        self._max_concurrent = max_concurrent or max(1, os.cpu_count() - 1)
+        self._min_rate_scale = min_rate_scale
+        self._aging_time = aging_time
+        self._pressure_monitor = pressure_monitor or PressureMonitor()
+        self._entries = {}
+        self._running = 0
+        self._condition = Condition()
+
+    def register(self, detector, rate=None, priority=0):
+        self._entries[detector] = _Entry(detector.rate() if rate is None else rate, priority)
+        detector.set_scheduler(self)
+
+    def _update_rate(self, entry):
+        # Back off under pressure, the lowest priority detectors the most
+        if entry.rate <= 0:
+            return
+        max_priority = max(other.priority for other in self._entries.values())
+        backoff = 1 / (1 + max_priority - entry.priority)
+        scale = max(self._min_rate_scale, 1 - self._pressure_monitor.pressure() * (1 - backoff / 2))
+        entry.effective_rate = entry.rate * scale
+
+    def _has_turn(self, entry):
+        # Wait for a free slot, higher priority detectors that are due go first
+        if self._running >= self._max_concurrent:
+            return False
+        now = time.time()
+        priority = entry.effective_priority(now, self._aging_time)
+        return all(not other.waiting or other.effective_priority(now, self._aging_time) <= priority
+                   for other in self._entries.values())
+
+    def acquire(self, detector, is_stopped):
+        entry = self._entries[detector]
+        with self._condition:
+            self._update_rate(entry)
+
+            # Rate limit, woken early only to stop
+            delay = entry.next_time - time.time()
+            if delay > 0:
+                self._condition.wait_for(is_stopped, delay)
+
+            entry.waiting = True
+            entry.wait_start = time.time()
+            self._condition.wait_for(lambda: is_stopped() or self._has_turn(entry))
+            entry.waiting = False
+            if is_stopped():
+                self._condition.notify_all()
+                return False
+
+            self._running += 1
+            if entry.effective_rate > 0:
+                entry.next_time = time.time() + 1 / entry.effective_rate
+            return True
+
+    def release(self, detector):
+        with self._condition:
+            self._running -= 1
+            self._condition.notify_all()
+
+    def wake(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def max_concurrent(self):
+        return self._max_concurrent
+
+    def effective_rate(self, detector):
+        return self._entries[detector].effective_rate
+
+    def pressure(self):
+        return self._pressure_monitor.pressure()
@@ -0,0 +1,330 @@
+import json
+import logging
+import time
+from threading import Event, Thread
+
+from trackstormsbot.metrics import REGISTRY
+from trackstormsbot.streaming import StreamBroadcaster, StreamEncoder
+from trackstormsbot.targets import TargetSelector
+from trackstormsbot.utils import *
+
+log = logging.getLogger(__name__)
+
+
+class TrackingService:
+
+    def __init__(self,
+                 camera,
+                 detector,
+                 gesture_recogniser,
+                 controller,
+                 distance_sensor,
+                 control_rate=30,
+                 disable_controller=False,
+                 show_latency=False,
+                 hat=None,
+                 stream_size=None,
+                 stream_quality=80,
+                 stream_fps=15,
+                 stream_encoder='auto',
+                 server_overlay=False,
+                 metadata_only=False,
+                 rig_id=None,
+                 model_pool=None,
+                 recorder=None,
+                 max_result_age=0.5):
+        self._camera = camera
+        self._rig_id = rig_id
+        # Every rig has its own series in the metrics, a single rig keeps them unlabelled
+        self._metric_labels = {'rig': rig_id} if rig_id is not None else {}
+        self._model_pool = model_pool
+        self._recorder = recorder
+        # What was last recorded, the recorder only gets changes
+        self._recorded = {'faces': None, 'hands': None, 'pwm': None, 'distance': None}
+        self._detector = detector
+        self._gesture_recogniser = gesture_recogniser
+        # Without a gesture recogniser the detector is fused and labels its faces with (hands, gesture)
+        self._fused = gesture_recogniser is None
+        self._controller = controller
+        self._distance_sensor = distance_sensor
+        self._control_rate = control_rate
+        # Results older than this are not steered on, the face has likely moved on since the frame was captured
+        self._max_result_age = max_result_age
+        self._targets = TargetSelector()
+        self._target = None
+        self._target_seq = None
+        self._stale_seq = None
+        self._stale_results = 0
+        self._result_age = 0
+        self._disable_controller = disable_controller
+        self._show_latency = show_latency
+        self._hat = hat
+        self._metadata_only = metadata_only
+        self._broadcaster = StreamBroadcaster()
+        self._events = StreamBroadcaster()
+        self._stats_overlay = StatsOverlay()
+        # Overlays are drawn by the browser from the event stream, unless they are burned into the video
+        self._encoder = StreamEncoder(self._camera.subscribe(),
+                                      self._broadcaster,
+                                      render=self.render if server_overlay else None,
+                                      size=stream_size,
+                                      quality=stream_quality,
+                                      max_fps=stream_fps,
+                                      encoder=stream_encoder,
+                                      metric_labels=self._metric_labels)
+
+        frame_size = self._camera.size()
+        self._frame_size = frame_size
+        self._frame_middle = (frame_size[0] // 2, frame_size[1] // 2)
+
+        self._stopped = Event()
+        self._state = {'detection': None, 'face_landmarks': [], 'landmarks': [], 'gesture': 'None'}
+        self._control_fps = 0
+        self._control_time = 0
+        self._last_event = None
+        self._stats_snapshot = {}
+        self._stats_time = 0
+        self._control_thread = Thread(target=self.control, args=(), daemon=True)
+
+    def warm_up(self, iterations=2):
+        # Done once before start(), so the first frames are not slowed down by model initialisation
+        self._detector.warm_up(iterations)
+        if not self._fused:
+            self._gesture_recogniser.warm_up(iterations)
+
+    def start(self):
+        self._stopped.clear()
+        if self._hat is not None:
+            self._hat.start()
+        if self._recorder is not None:
+            self._recorder.start()
+        self._camera.open()
+        if not self._fused:
+            self._gesture_recogniser.start()
+        self._detector.start()
+        self._control_thread.start()
+        if not self._metadata_only:
+            self._encoder.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._encoder.stop()
+        self._detector.stop()
+        if not self._fused:
+            self._gesture_recogniser.stop()
+        if not self._disable_controller:
+            self._controller.stop()
+        if self._hat is not None:
+            self._hat.stop()
+        self._camera.close()
+        if self._recorder is not None:
+            self._recorder.stop()
+        self._broadcaster.close()
+        self._events.close()
+
+    def wait(self):
+        while not self._stopped.wait(1.0):
+            if not self._camera.is_opened():
+                self.stop()
+
+    def is_running(self):
+        return not self._stopped.is_set()
+
+    def broadcaster(self):
+        return self._broadcaster
+
+    def events(self):
+        return self._events
+
+    def rig_id(self):
+        return self._rig_id
+
+    def metadata_only(self):
+        return self._metadata_only
+
+    def state(self):
+        return self._state
+
+    def control(self):
+        period = 1 / self._control_rate
+        next_time = time.perf_counter()
+        loop_count = 0
+        fps_timer = time.perf_counter()
+
+        while not self._stopped.is_set() and self._camera.is_opened():
+            start_time = time.perf_counter()
+            self.control_step()
+            elapsed = time.perf_counter() - start_time
+            self._control_time = 0.9 * self._control_time + 0.1 * elapsed
+            REGISTRY.observe('stage_latency', elapsed, stage='control', **self._metric_labels)
+
+            loop_count += 1
+            if loop_count % self._control_rate == 0:
+                self._control_fps = loop_count / (time.perf_counter() - fps_timer)
+                loop_count = 0
+                fps_timer = time.perf_counter()
+
+            # Fixed control frequency, skip ahead instead of bursting when a step overran
+            next_time += period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                self._stopped.wait(delay)
+            else:
+                next_time = time.perf_counter()
+
+    def control_step(self):
+        # One reference read, so detections, labels, seq and timestamp all belong to the same frame
+        result = self._detector.result()
+        detections = result.detections
+        hands, gesture = result.labels if self._fused else self._gesture_recogniser.read()
+
+        # Tracks are associated once per result, the control loop usually runs faster than the detector. Steer
+        # on the same person across frames rather than whichever face is most confident on each one
+        if result.seq != self._target_seq:
+            self._target_seq = result.seq
+            switches = self._targets.switches()
+            self._target = self._targets.update(detections)
+            if self._targets.switches() > switches:
+                REGISTRY.inc('target_switches', **self._metric_labels)
+
+        stale = False
+        if result.timestamp is not None:
+            age = time.time() - result.timestamp
+            self._result_age = 0.9 * self._result_age + 0.1 * age
+            REGISTRY.observe('result_age', age, **self._metric_labels)
+            stale = age > self._max_result_age
+            if stale and result.seq != self._stale_seq:
+                self._stale_seq = result.seq
+                self._stale_results += 1
+                REGISTRY.inc('stale_results', **self._metric_labels)
+
+        best = None if stale else self._target
+        detection = None if best is None else detections.box(best)
+
+        if not self._disable_controller:
+            if detection is not None:
+                relative_size = detection[2] * detection[3] / (self._frame_size[0] * self._frame_size[1])
+                middle = calculate_middle_xywh(detection)
+                self._controller.move_to_middle(
+                    frame_middle=self._frame_middle,
+                    detection_middle=middle,
+                    detection_size=relative_size,
+                    timestamp=result.timestamp,
+                )
+
+                # From the capture of the frame the detection came from until the motor command
+                REGISTRY.observe('glass_to_motor', time.time() - result.timestamp, **self._metric_labels)
+            else:
+                self._controller.stop()
+
+        if self._distance_sensor is not None:
+            if gesture == 'point':
+                self._distance_sensor.set_eyes(100, 100, 100, 100)
+            else:
+                self._distance_sensor.set_eyes(0, 0, 0, 0)
+
+        if self._recorder is not None:
+            self.record(detections, hands, gesture)
+
+        # Replaced as a whole so readers never see a half updated state
+        self._state = {
+            'detection': detection,
+            'face_landmarks': [] if best is None else detections.points(best),
+            'landmarks': hands.points(),
+            'gesture': gesture,}
+        self.publish_event(detections, best, hands, gesture, stale)
+
+    def record(self, detections, hands, gesture):
+        # Results once per new frame, commands and readings when they change. Commands and readings are keyed
+        # by the frame the current face detections came from
+        recorded = self._recorded
+        if detections.seq != recorded['faces']:
+            recorded['faces'] = detections.seq
+            self._recorder.record_faces(detections)
+        if hands.seq is not None and (hands.seq, gesture) != recorded['hands']:
+            recorded['hands'] = (hands.seq, gesture)
+            self._recorder.record_hands(hands, gesture)
+        if not self._disable_controller and self._controller.pwm() != recorded['pwm']:
+            recorded['pwm'] = self._controller.pwm()
+            self._recorder.record_pwm(detections.seq, detections.timestamp, recorded['pwm'])
+        distance = None if self._distance_sensor is None else self._distance_sensor.get_distance()
+        if distance is not None and distance != recorded['distance']:
+            recorded['distance'] = distance
+            self._recorder.record_distance(detections.seq, detections.timestamp, distance)
+
+    def publish_event(self, detections, best, hands, gesture, stale=False):
+        # Once per new detector result while anyone is listening, stats are refreshed once a second
+        now = time.time()
+        key = (detections.seq, hands.seq, gesture, stale)
+        stats_due = now - self._stats_time >= 1.0
+        if not self._events.has_subscribers() or (key == self._last_event and not stats_due):
+            return
+        self._last_event = key
+        if stats_due:
+            self._stats_snapshot = {name: str(value) for name, value in self.stats().items()}
+            self._stats_time = now
+
+        event = {
+            'seq': detections.seq,
+            'timestamp': detections.timestamp,
+            'frame_size': list(self._frame_size),
+            'faces': detections.to_list(),
+            'face_ids': self._targets.ids(),
+            'target': best,
+            'stale': stale,
+            'face_landmarks': [] if best is None else detections.points(best),
+            'hand_seq': hands.seq,
+            'hands': hands.to_list(),
+            'hand_landmarks': hands.points(),
+            'gesture': gesture,
+            'stats': self._stats_snapshot,}
+        self._events.publish(json.dumps(event).encode())
+
+    def stats(self):
+        # A fused detector recognises gestures on every frame it detects faces on
+        gesture_recogniser = self._detector if self._fused else self._gesture_recogniser
+        gesture_preprocess_time = (self._detector.gesture_recogniser()
+                                   if self._fused else self._gesture_recogniser).preprocess_time()
+        rig = {'Rig': self._rig_id} if self._rig_id is not None else {}
+        distance = {'Distance (cm)': self._distance_sensor.get_distance()} if self._distance_sensor is not None else {}
+        return {
+            **rig,
+            'FPS (Camera)': int(self._camera.fps()),
+            'Capture CPU (ms)': f'{self._camera.capture_cpu():.1f}',
+            'FPS (Detector)': int(self._detector.fps()),
+            'FPS (Gesture)': int(gesture_recogniser.fps()),
+            'FPS (Control)': int(self._control_fps),
+            'Control (ms)': f'{self._control_time * 1000:.1f}',
+            'Latency ms (Det/Gest)': f'{self._detector.latency():.0f}/{gesture_recogniser.latency():.0f}',
+            'Preproc ms (Det/Gest)': f'{self._detector.preprocess_time():.1f}/{gesture_preprocess_time:.1f}',
+            'Result age ms': f'{self._result_age * 1000:.0f}',
+            'Target switches / stale': f'{self._targets.switches()} / {self._stale_results}',
+            **self._detector.stats(),
+            **({} if self._fused else self._gesture_recogniser.stats()),
+            **(self.latency_stats() if self._show_latency else {}),
+            **(self._hat.stats() if self._hat is not None else {}),
+            **self._encoder.stats(),
+            **(self._model_pool.stats() if self._model_pool is not None else {}),
+            **(self._recorder.stats() if self._recorder is not None else {}),
+            **distance,
+            'Gesture': self._state['gesture'],}
+
+    def latency_stats(self):
+        glass_to_motor = REGISTRY.quantiles('glass_to_motor', **self._metric_labels)
+        encode = REGISTRY.quantiles('stage_latency', stage='encode', **self._metric_labels)
+        return {
+            'Glass-to-motor ms (p50/p95/p99)': '/'.join(f'{value * 1000:.0f}' for value in glass_to_motor.values()),
+            'Encode ms (p50/p95/p99)': '/'.join(f'{value * 1000:.0f}' for value in encode.values()),}
+
+    def render(self, frame):
+        state = self._state
+
+        # Frames on the bus are read-only and shared, copy once for drawing
+        frame_vis = frame.image.copy()
+
+        if not self._disable_controller and state['detection'] is not None:
+            frame_vis = visualise_detection(frame_vis, state['detection'])
+            frame_vis = visualise_landmarks(frame_vis, state['face_landmarks'])
+            frame_vis = visualise_landmarks(frame_vis, state['landmarks'])
+
+        return self._stats_overlay.draw(frame_vis, self.stats)
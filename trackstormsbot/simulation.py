@@ -0,0 +1,235 @@
+import math
+import time
+
+import cv2
+import numpy as np
+
+from trackstormsbot.sources import FrameSource
+
+
+class SimulatedMotor:
+    # Build HAT motor stand-in: the speed follows the pwm with a first order lag and the position integrates it.
+    # State is advanced lazily from the clock, so the simulation can run on virtual time, or time_scale times
+    # faster than real time. Every command blocks for the serial round trip like the real motor does
+
+    def __init__(self,
+                 port=None,
+                 max_speed=300,
+                 time_constant=0.08,
+                 deadzone=0.05,
+                 serial_latency=0,
+                 time_scale=1.0,
+                 clock=time.perf_counter):
+        self.port = port
+        self._max_speed = max_speed * time_scale
+        self._time_constant = time_constant / time_scale
+        self._deadzone = deadzone
+        self._serial_latency = serial_latency / time_scale
+        self._clock = clock
+        self._pwm = 0
+        self._speed = 0
+        self._position = 0
+        self._last_time = clock()
+
+    def _advance(self):
+        now = self._clock()
+        dt = now - self._last_time
+        self._last_time = now
+        if dt <= 0:
+            return
+
+        # Exact solution of the first order response over dt
+        target = 0 if abs(self._pwm) < self._deadzone else self._pwm * self._max_speed
+        decay = math.exp(-dt / self._time_constant)
+        self._position += target * dt + (self._speed - target) * self._time_constant * (1 - decay)
+        self._speed = target + (self._speed - target) * decay
+
+    def _serial(self):
+        if self._serial_latency > 0:
+            time.sleep(self._serial_latency)
+
+    def pwm(self, value):
+        self._serial()
+        self._advance()
+        self._pwm = max(-1, min(1, value))
+
+    def stop(self):
+        self.pwm(0)
+
+    def run_to_position(self, degrees, blocking=True):
+        # Not modelled, the motor jumps to the position
+        self._serial()
+        self._advance()
+        self._position = degrees
+        self._speed = 0
+        self._pwm = 0
+
+    def get_position(self):
+        self._serial()
+        self._advance()
+        return self._position
+
+    def get_speed(self):
+        self._serial()
+        self._advance()
+        return self._speed
+
+
+class SimulatedPanTilt:
+    # Pan/tilt head with a camera, projecting a target given in degrees to pixel coordinates
+
+    def __init__(self, motor_x, motor_y, frame_size=(640, 480), pixels_per_degree=(10, 10)):
+        self.motor_x = motor_x
+        self.motor_y = motor_y
+        self._frame_middle = np.array(frame_size, dtype=np.float64) / 2
+        self._pixels_per_degree = np.array(pixels_per_degree, dtype=np.float64)
+
+    def pointing(self):
+        return np.array([self.motor_x.get_position(), self.motor_y.get_position()])
+
+    def project(self, target):
+        # A positive pan moves the target right in the image, a positive tilt moves it up
+        offset = (self.pointing() - np.asarray(target, dtype=np.float64)) * self._pixels_per_degree
+        return self._frame_middle + offset * np.array([1, -1])
+
+
+class SimulatedDistanceSensor:
+    # Build HAT distance sensor stand-in, the distance is set by the simulation
+
+    def __init__(self, port=None, distance=80, serial_latency=0, time_scale=1.0):
+        self.port = port
+        self.distance = distance
+        self.eye_values = (0, 0, 0, 0)
+        self._serial_latency = serial_latency / time_scale
+
+    def _serial(self):
+        if self._serial_latency > 0:
+            time.sleep(self._serial_latency)
+
+    def get_distance(self):
+        self._serial()
+        return self.distance
+
+    def eyes(self, *values):
+        self._serial()
+        self.eye_values = values
+
+
+def draw_face(size):
+    # Cartoon face the cascade and YuNet detectors pick up
+    image = np.full((size, size, 3), 40, dtype=np.uint8)
+    middle = size // 2
+    cv2.ellipse(image, (middle, middle), (int(size * 0.38), int(size * 0.48)), 0, 0, 360, (150, 175, 210), -1)
+    for side in (-1, 1):
+        eye = (middle + side * int(size * 0.16), int(size * 0.40))
+        cv2.ellipse(image, eye, (int(size * 0.08), int(size * 0.045)), 0, 0, 360, (40, 40, 40), -1)
+        cv2.line(image, (middle + side * int(size * 0.08), int(size * 0.30)),
+                 (middle + side * int(size * 0.25), int(size * 0.29)), (50, 50, 60), max(2, size // 30))
+    cv2.ellipse(image, (middle, int(size * 0.58)), (int(size * 0.05), int(size * 0.09)), 0, 0, 360, (120, 140, 175), -1)
+    cv2.ellipse(image, (middle, int(size * 0.72)), (int(size * 0.14), int(size * 0.04)), 0, 0, 360, (60, 60, 120), -1)
+    return cv2.GaussianBlur(image, (5, 5), 0)
+
+
+class SimulatedRig:
+    # Motors, distance sensor and camera of one pan/tilt head, with a face wandering around in front of it.
+    # With time_scale > 1 the motors, the face and the camera frame rate all run that many times faster
+
+    def __init__(self,
+                 frame_size=(640, 480),
+                 fps=30,
+                 pixels_per_degree=(10, 10),
+                 face_size=100,
+                 amplitude=(25, 8),
+                 period=(12, 9),
+                 serial_latency=0.003,
+                 time_scale=1.0,
+                 seed=0):
+        self._frame_size = frame_size
+        self._fps = fps
+        self._pixels_per_degree = np.array(pixels_per_degree, dtype=np.float64)
+        self._face = draw_face(face_size)
+        self._amplitude = np.array(amplitude, dtype=np.float64)
+        self._period = np.array(period, dtype=np.float64)
+        self._serial_latency = serial_latency
+        self._time_scale = time_scale
+        self._start_time = time.perf_counter()
+        self._motors = {}
+        self._distance_sensor = None
+        self._pan_tilt = None
+
+        # Blurred noise, wide enough for the camera to pan over the whole range of the face
+        rng = np.random.default_rng(seed)
+        margin = (self._amplitude * 2 * self._pixels_per_degree).astype(int) + face_size
+        shape = (frame_size[1] + 2 * margin[1], frame_size[0] + 2 * margin[0], 3)
+        self._background = cv2.GaussianBlur(rng.integers(40, 200, shape, dtype=np.uint8), (0, 0), 3)
+        self._margin = margin
+
+    def motor(self, port):
+        # Drop in for buildhat.Motor, the first port created is the pan motor and the second the tilt motor
+        if port not in self._motors:
+            self._motors[port] = SimulatedMotor(port, serial_latency=self._serial_latency, time_scale=self._time_scale)
+            if len(self._motors) == 2:
+                self._pan_tilt = SimulatedPanTilt(*self._motors.values(), self._frame_size, self._pixels_per_degree)
+        return self._motors[port]
+
+    def distance_sensor(self, port):
+        # Drop in for buildhat.DistanceSensor
+        if self._distance_sensor is None:
+            self._distance_sensor = SimulatedDistanceSensor(port,
+                                                            serial_latency=self._serial_latency,
+                                                            time_scale=self._time_scale)
+        return self._distance_sensor
+
+    def target(self):
+        # Face position in degrees, a slow Lissajous figure in simulated time
+        elapsed = (time.perf_counter() - self._start_time) * self._time_scale
+        return self._amplitude * np.sin(2 * np.pi * elapsed / self._period)
+
+    def pointing(self):
+        if self._pan_tilt is None:
+            return np.zeros(2)
+        return self._pan_tilt.pointing()
+
+    def render(self, target=None):
+        # The face at target degrees instead of where it wandered to, for still samples
+        target = self.target() if target is None else np.asarray(target, dtype=np.float64)
+        width, height = self._frame_size
+        offset = np.round(self.pointing() * self._pixels_per_degree).astype(int) * np.array([-1, 1])
+        x, y = np.clip(self._margin + offset, 0, self._margin * 2)
+        image = self._background[y:y + height, x:x + width].copy()
+
+        # Same projection as SimulatedPanTilt, the face centre relative to the frame middle
+        middle = np.array(self._frame_size, dtype=np.float64) / 2
+        face = middle + (self.pointing() - target) * self._pixels_per_degree * np.array([1, -1])
+        size = len(self._face)
+        left, top = (face - size / 2).astype(int)
+        crop_left, crop_top = max(0, -left), max(0, -top)
+        crop_right, crop_bottom = min(size, width - left), min(size, height - top)
+        if crop_right > crop_left and crop_bottom > crop_top:
+            image[top + crop_top:top + crop_bottom, left + crop_left:left + crop_right] = \
+                self._face[crop_top:crop_bottom, crop_left:crop_right]
+        return image
+
+    def source(self, lores_size=None):
+        return SimulatedCameraSource(self, self._frame_size, self._fps * self._time_scale, lores_size)
+
+
+class SimulatedCameraSource(FrameSource):
+    # What the camera on a simulated rig sees, paced at the (time scaled) frame rate
+
+    def __init__(self, rig, size=(640, 480), fps=30, lores_size=None):
+        super().__init__(size, fps, lores_size)
+        self._rig = rig
+        self._next_time = 0
+
+    def open(self):
+        self._next_time = time.time()
+
+    def read(self):
+        delay = self._next_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_time = max(self._next_time + 1 / self._fps, time.time() - 1 / self._fps)
+
+        image = self._rig.render()
+        return image, self._lores(image)
@@ -0,0 +1,242 @@
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class FrameSource:
+    # Produces (image, lores) pairs, lores is an optional low resolution version for the detectors
+
+    def __init__(self, size=(640, 480), fps=30, lores_size=None):
+        self._size = size
+        self._fps = fps
+        self._lores_size = lores_size
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def read(self):
+        raise NotImplementedError
+
+    def size(self):
+        return self._size
+
+    def fps(self):
+        return self._fps
+
+    def lores_size(self):
+        return self._lores_size
+
+    def _lores(self, image):
+        # Sources without a hardware low resolution stream downscale once in the capture thread
+        if self._lores_size is None:
+            return None
+        return cv2.resize(image, self._lores_size, interpolation=cv2.INTER_AREA)
+
+
+class VideoCaptureSource(FrameSource):
+    FOURCCS = ['MJPG', 'YUYV']
+
+    def __init__(self, index, size=(640, 480), fps=None, fourcc=None, lores_size=None):
+        super().__init__(size, fps, lores_size)
+        self._index = index
+        self._fourcc = fourcc
+        self._cap = None
+
+    def open(self):
+        # An explicit FOURCC needs the V4L2 backend, otherwise let OpenCV negotiate the format
+        if self._fourcc is not None:
+            self._cap = cv2.VideoCapture(self._index, cv2.CAP_V4L2)
+            self._cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self._fourcc))
+        else:
+            self._cap = cv2.VideoCapture(self._index)
+        if self._size is not None:
+            self._cap.set(cv2.CAP_PROP_FRAME_WIDTH, self._size[0])
+            self._cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self._size[1])
+        if self._fps is not None:
+            self._cap.set(cv2.CAP_PROP_FPS, self._fps)
+
+        self._size = (int(self._cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self._fps = self._cap.get(cv2.CAP_PROP_FPS)
+        fourcc = int(self._cap.get(cv2.CAP_PROP_FOURCC)).to_bytes(4, 'little').decode(errors='replace')
+        log.info(f'Opened camera {self._index} with format {fourcc}, size {self._size} and fps {self._fps}')
+
+    def close(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+    def read(self):
+        status, image = self._cap.read()
+        if not status:
+            return None, None
+        return image, self._lores(image)
+
+
+class Picamera2Source(FrameSource):
+    # Raspberry Pi camera through libcamera, the ISP produces the low resolution stream for free
+
+    def __init__(self, size=(640, 480), fps=30, lores_size=None):
+        super().__init__(size, fps, lores_size)
+        self._camera = None
+
+    def open(self):
+        from picamera2 import Picamera2
+
+        self._camera = Picamera2()
+        # libcamera names formats by their word order, RGB888 is stored as B, G, R bytes like OpenCV expects
+        streams = {'main': {'size': self._size, 'format': 'RGB888'}}
+        if self._lores_size is not None:
+            streams['lores'] = {'size': self._lores_size, 'format': 'YUV420'}
+        config = self._camera.create_video_configuration(
+            **streams,
+            controls={'FrameRate': self._fps},
+        )
+        self._camera.configure(config)
+        self._camera.start()
+
+    def close(self):
+        if self._camera is not None:
+            self._camera.stop()
+            self._camera.close()
+            self._camera = None
+
+    def read(self):
+        if self._lores_size is None:
+            return self._camera.capture_array('main'), None
+
+        request = self._camera.capture_request()
+        try:
+            image = request.make_array('main')
+            lores = cv2.cvtColor(request.make_array('lores'), cv2.COLOR_YUV2BGR_I420)
+        finally:
+            request.release()
+        return image, lores
+
+
+def _read_video(path):
+    # Comparing frames against a sentinel is ambiguous for arrays, stop on the read flag instead
+    cap = cv2.VideoCapture(path)
+    try:
+        while True:
+            ok, image = cap.read()
+            if not ok:
+                return
+            yield image
+    finally:
+        cap.release()
+
+
+class FileSource(FrameSource):
+    # Video file or directory of images, paced at the file frame rate unless realtime is disabled
+
+    def __init__(self, path, size=(640, 480), fps=30, loop=True, realtime=True, lores_size=None):
+        super().__init__(size, fps, lores_size)
+        self._path = path
+        self._loop = loop
+        self._realtime = realtime
+        self._frames = None
+        self._next_time = 0
+
+    def open(self):
+        if not os.path.isdir(self._path):
+            cap = cv2.VideoCapture(self._path)
+            if not cap.isOpened():
+                raise ValueError(f'Could not open {self._path}')
+            self._fps = cap.get(cv2.CAP_PROP_FPS) or self._fps
+            cap.release()
+        self._frames = self.frames()
+        self._next_time = time.time()
+
+    def frames(self):
+        while True:
+            if os.path.isdir(self._path):
+                names = sorted(name for name in os.listdir(self._path) if name.lower().endswith(IMAGE_EXTENSIONS))
+                images = (cv2.imread(os.path.join(self._path, name)) for name in names)
+            else:
+                images = _read_video(self._path)
+
+            for image in images:
+                if image is None:
+                    continue
+                if self._size is not None and (image.shape[1], image.shape[0]) != tuple(self._size):
+                    image = cv2.resize(image, self._size, interpolation=cv2.INTER_AREA)
+                yield image
+
+            if not self._loop:
+                return
+
+    def read(self):
+        if self._realtime:
+            delay = self._next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self._next_time = max(self._next_time + 1 / self._fps, time.time() - 1 / self._fps)
+
+        image = next(self._frames, None)
+        if image is None:
+            return None, None
+        return image, self._lores(image)
+
+
+class SyntheticSource(FrameSource):
+    # Textured blob moving over a noisy background, for testing the pipeline without a camera
+
+    def __init__(self, size=(640, 480), fps=30, speed=(4, 2), blob_size=80, lores_size=None, seed=0):
+        super().__init__(size, fps, lores_size)
+        self._speed = np.array(speed, dtype=np.float32)
+        self._blob_size = blob_size
+        rng = np.random.default_rng(seed)
+        self._background = rng.integers(0, 64, (size[1], size[0], 3), dtype=np.uint8)
+        self._blob = rng.integers(128, 255, (blob_size, blob_size, 3), dtype=np.uint8)
+        self._position = np.array([size[0] / 2, size[1] / 2], dtype=np.float32)
+        self._next_time = 0
+
+    def open(self):
+        self._next_time = time.time()
+
+    def position(self):
+        return tuple(int(v) for v in self._position)
+
+    def read(self):
+        delay = self._next_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_time = max(self._next_time + 1 / self._fps, time.time() - 1 / self._fps)
+
+        # Bounce off the frame edges
+        limit = np.array(self._size, dtype=np.float32) - self._blob_size
+        self._position += self._speed
+        for axis in range(2):
+            if not 0 <= self._position[axis] <= limit[axis]:
+                self._speed[axis] = -self._speed[axis]
+                self._position[axis] = np.clip(self._position[axis], 0, limit[axis])
+
+        image = self._background.copy()
+        x, y = self.position()
+        image[y:y + self._blob_size, x:x + self._blob_size] = self._blob
+        return image, self._lores(image)
+
+
+SOURCES = ['camera', 'picamera2', 'file', 'synthetic']
+
+
+def get_source(name, camera=0, path=None, size=(640, 480), fourcc=None, lores_size=None):
+    if name == 'camera':
+        return VideoCaptureSource(camera, size, fourcc=fourcc, lores_size=lores_size)
+    if name == 'picamera2':
+        return Picamera2Source(size, lores_size=lores_size)
+    if name == 'file':
+        return FileSource(path, size, lores_size=lores_size)
+    if name == 'synthetic':
+        return SyntheticSource(size, lores_size=lores_size)
+    raise ValueError(f'Unknown frame source {name}')
@@ -0,0 +1,192 @@
+import logging
+import time
+from collections import deque
+from threading import Condition, Event, Thread
+
+import cv2
+
+from trackstormsbot.metrics import REGISTRY
+
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+log = logging.getLogger(__name__)
+
+
+class StreamBroadcaster:
+
+    def __init__(self, buffer_size=4):
+        self._buffer = deque(maxlen=buffer_size)
+        self._seq = 0
+        self._subscribers = 0
+        self._dropped = 0
+        self._closed = False
+        self._condition = Condition()
+
+    def publish(self, data):
+        with self._condition:
+            self._seq += 1
+            self._buffer.append((self._seq, data))
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def has_subscribers(self):
+        return self._subscribers > 0
+
+    def subscribers(self):
+        return self._subscribers
+
+    def dropped(self):
+        return self._dropped
+
+    def subscribe(self, timeout=1.0):
+        with self._condition:
+            self._subscribers += 1
+            last_seq = self._seq
+        log.info(f'Stream subscriber connected ({self._subscribers} total)')
+
+        try:
+            while not self._closed:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._closed or self._seq > last_seq, timeout)
+                    if self._closed or self._seq <= last_seq:
+                        continue
+
+                    # Always jump to the newest frame, slow clients drop whatever they missed
+                    seq, data = self._buffer[-1]
+                    self._dropped += seq - last_seq - 1
+                    last_seq = seq
+
+                yield data
+        finally:
+            with self._condition:
+                self._subscribers -= 1
+            log.info(f'Stream subscriber disconnected ({self._subscribers} total)')
+
+
+class StreamEncoder:
+    # Renders and JPEG encodes camera frames for the web feed on its own thread, at most max_fps times a second.
+    # The quality drops while viewers miss frames and slowly recovers when they keep up
+    ENCODERS = ['auto', 'opencv', 'simplejpeg']
+
+    def __init__(self,
+                 frame_reader,
+                 broadcaster,
+                 render=None,
+                 size=None,
+                 quality=80,
+                 min_quality=30,
+                 max_fps=15,
+                 encoder='auto',
+                 adapt_interval=15,
+                 metric_labels=None):
+        if encoder == 'auto':
+            encoder = 'simplejpeg' if simplejpeg is not None else 'opencv'
+        if encoder == 'simplejpeg' and simplejpeg is None:
+            raise ValueError('The simplejpeg encoder requires the simplejpeg package')
+
+        self._frame_reader = frame_reader
+        self._broadcaster = broadcaster
+        self._render = render
+        self._size = size
+        self._max_quality = quality
+        self._min_quality = min_quality
+        self._quality = quality
+        self._period = 1 / max_fps if max_fps > 0 else 0
+        self._encoder = encoder
+        self._adapt_interval = adapt_interval
+        self._metric_labels = metric_labels or {}
+        self._stopped = Event()
+        self._thread = None
+
+        self._fps = 0
+        self._bytes_per_second = 0
+        self._last_time = None
+        self._encoded = 0
+        self._last_dropped = 0
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = Thread(target=self.run, args=(), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        next_time = 0
+        while not self._stopped.is_set():
+            frame = self._frame_reader.next(timeout=1.0)
+            if frame is None and self._frame_reader.closed():
+                # No more frames will come, next() would return straight away and spin
+                break
+
+            # Only visualise and encode while someone is watching, and no more often than max_fps
+            if frame is None or not self._broadcaster.has_subscribers() or time.perf_counter() < next_time:
+                continue
+            start_time = time.perf_counter()
+            next_time = max(next_time + self._period, start_time)
+
+            # Encoded once and shared by all viewers
+            data = self.encode(frame.image if self._render is None else self._render(frame))
+            elapsed = time.perf_counter() - start_time
+            REGISTRY.observe('stage_latency', elapsed, stage='encode', **self._metric_labels)
+            self._broadcaster.publish(data)
+            REGISTRY.observe('glass_to_stream', time.time() - frame.timestamp, **self._metric_labels)
+
+            self._update_rates(start_time, len(data))
+            self._encoded += 1
+            if self._encoded % self._adapt_interval == 0:
+                self._adapt_quality()
+
+    def encode(self, image):
+        if self._size is not None and (image.shape[1], image.shape[0]) != tuple(self._size):
+            image = cv2.resize(image, self._size, interpolation=cv2.INTER_AREA)
+        if self._encoder == 'simplejpeg':
+            return simplejpeg.encode_jpeg(image, quality=self._quality, colorspace='BGR', fastdct=True)
+        _, buffer = cv2.imencode('.jpeg', image, [cv2.IMWRITE_JPEG_QUALITY, self._quality])
+        return buffer.tobytes()
+
+    def _update_rates(self, start_time, size):
+        if self._last_time is not None:
+            interval = max(start_time - self._last_time, 1e-3)
+            self._fps = 0.9 * self._fps + 0.1 / interval
+            self._bytes_per_second = 0.9 * self._bytes_per_second + 0.1 * size / interval
+        self._last_time = start_time
+
+    def _adapt_quality(self):
+        # Frames dropped for a viewer mean it can not download them as fast as they are encoded
+        dropped = self._broadcaster.dropped()
+        drop_ratio = (dropped - self._last_dropped) / self._adapt_interval
+        self._last_dropped = dropped
+        if drop_ratio > 0.2:
+            self._quality = max(self._min_quality, self._quality - 10)
+        elif drop_ratio == 0:
+            self._quality = min(self._max_quality, self._quality + 5)
+
+    def quality(self):
+        return self._quality
+
+    def fps(self):
+        return self._fps
+
+    def stats(self):
+        return {'Stream': f'{self._fps:.0f} fps q{self._quality} {self._bytes_per_second / 1024:.0f} kB/s'}
+
+
+def mjpeg_stream(subscription):
+    for frame in subscription:
+        yield (b'--frame\r\n'
+               b'Content-type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+
+
+def sse_stream(subscription):
+    # Server-sent events, one JSON document per event
+    for event in subscription:
+        yield b'data: ' + event + b'\n\n'
@@ -0,0 +1,118 @@
+import numpy as np
+
+from trackstormsbot.detections import box_iou
+
+
+def _greedy_match(scores, min_score):
+    # One to one (row, column) pairs, highest scores first
+    scores = scores.copy()
+    pairs = []
+    while scores.size > 0 and scores.max() >= min_score:
+        row, column = np.unravel_index(scores.argmax(), scores.shape)
+        scores[row, :] = -np.inf
+        scores[:, column] = -np.inf
+        pairs.append((int(row), int(column)))
+    return pairs
+
+
+class TrackAssociator:
+    # Gives the detections of consecutive results the same track id while they are of the same object. Boxes are
+    # matched on overlap first, what is left on centre distance relative to the box size, which still links a
+    # face that moved further than its own width between two results. Tracks are kept for max_missed results
+    # without a match, so a single missed detection does not start a new track
+
+    def __init__(self, min_iou=0.3, max_distance=1.0, max_missed=5):
+        self._min_iou = min_iou
+        self._max_distance = max_distance
+        self._max_missed = max_missed
+        self._boxes = np.zeros((0, 4), dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._missed = np.zeros(0, dtype=np.int32)
+        self._next_id = 0
+
+    def update(self, detections):
+        # Track ids of the detections, in their order
+        boxes = detections.boxes
+        ids = np.full(len(boxes), -1, dtype=np.int64)
+        matched_tracks = np.zeros(len(self._boxes), dtype=bool)
+
+        if len(boxes) > 0 and len(self._boxes) > 0:
+            scores = box_iou(boxes, self._boxes)
+            pairs = _greedy_match(scores, self._min_iou)
+
+            # A track missed for a few results may have moved further since it was last seen
+            distances = self._distances(boxes, self._boxes) / (1 + self._missed)
+            for row, column in pairs:
+                distances[row, :] = np.inf
+                distances[:, column] = np.inf
+            pairs += _greedy_match(-distances, -self._max_distance)
+
+            for row, column in pairs:
+                ids[row] = self._ids[column]
+                matched_tracks[column] = True
+                self._boxes[column] = boxes[row]
+                self._missed[column] = 0
+
+        self._missed[~matched_tracks] += 1
+        kept = self._missed <= self._max_missed
+        new = ids < 0
+        ids[new] = np.arange(self._next_id, self._next_id + new.sum())
+        self._next_id += int(new.sum())
+
+        self._boxes = np.concatenate((self._boxes[kept], boxes[new]))
+        self._ids = np.concatenate((self._ids[kept], ids[new]))
+        self._missed = np.concatenate((self._missed[kept], np.zeros(new.sum(), dtype=np.int32)))
+        return ids
+
+    @staticmethod
+    def _distances(boxes, track_boxes):
+        # Centre distance in units of the mean size of the two boxes
+        centres = boxes[:, None, :2] + boxes[:, None, 2:] / 2
+        track_centres = track_boxes[None, :, :2] + track_boxes[None, :, 2:] / 2
+        sizes = (np.sqrt(boxes[:, None, 2] * boxes[:, None, 3]) +
+                 np.sqrt(track_boxes[None, :, 2] * track_boxes[None, :, 3])) / 2
+        return np.hypot(*(centres - track_centres).transpose(2, 0, 1)) / np.maximum(sizes, 1)
+
+    def is_tracked(self, track_id):
+        return bool(np.any(self._ids == track_id))
+
+
+class TargetSelector:
+    # Keeps the same person selected for as long as their track lives, the most confident detection only becomes
+    # the target when there is none yet or the target's track was dropped. While the target is missed but still
+    # tracked there is no target, rather than a jump to someone else for a frame or two
+
+    def __init__(self, associator=None):
+        self._associator = associator or TrackAssociator()
+        self._target_id = None
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._switches = 0
+
+    def update(self, detections):
+        # Index of the target among the detections, None while it is not one of them
+        self._ids = self._associator.update(detections)
+        if self._target_id is not None:
+            index = np.flatnonzero(self._ids == self._target_id)
+            if len(index) > 0:
+                return int(index[0])
+            if self._associator.is_tracked(self._target_id):
+                return None
+
+        best = detections.best()
+        if best is None:
+            return None
+        target_id = int(self._ids[best])
+        if self._target_id is not None and target_id != self._target_id:
+            self._switches += 1
+        self._target_id = target_id
+        return best
+
+    def ids(self):
+        # Track ids of the detections passed to the last update
+        return self._ids.tolist()
+
+    def target_id(self):
+        return self._target_id
+
+    def switches(self):
+        return self._switches
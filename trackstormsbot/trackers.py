@@ -0,0 +1,187 @@
+import logging
+import time
+
+import cv2
+import numpy as np
+
+from trackstormsbot.detections import Detections
+from trackstormsbot.detectors import Detector
+
+log = logging.getLogger(__name__)
+
+
+class FlowTracker:
+    # Lucas-Kanade optical flow on corner features inside the box, confidence is the forward-backward inlier ratio
+    COLOR_TRANSFORM = 'gray'
+
+    def __init__(self, max_points=40, max_error=1.5, min_points=5):
+        self._max_points = max_points
+        self._max_error = max_error
+        self._min_points = min_points
+        self._prev_image = None
+        self._points = None
+        self._box = None
+
+    def init(self, image, box):
+        x, y, w, h = [int(v) for v in box]
+        mask = np.zeros_like(image)
+        mask[max(0, y):y + h, max(0, x):x + w] = 255
+        self._points = cv2.goodFeaturesToTrack(image, self._max_points, 0.01, 3, mask=mask)
+        self._prev_image = image
+        self._box = np.array(box, dtype=np.float32)
+
+    def update(self, image):
+        if self._points is None or len(self._points) < self._min_points:
+            return False, self._box, 0.0
+
+        points, status, _ = cv2.calcOpticalFlowPyrLK(self._prev_image, image, self._points, None)
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(image, self._prev_image, points, None)
+        error = np.linalg.norm(self._points - back_points, axis=2).ravel()
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < self._max_error)
+        confidence = float(good.mean())
+
+        if good.sum() < self._min_points:
+            return False, self._box, confidence
+
+        old, new = self._points[good].reshape(-1, 2), points[good].reshape(-1, 2)
+        shift = np.median(new - old, axis=0)
+
+        # Scale change from the ratio of pairwise point distances
+        old_dist = np.linalg.norm(old[:, None] - old[None], axis=2)
+        new_dist = np.linalg.norm(new[:, None] - new[None], axis=2)
+        valid = old_dist > 1
+        scale = float(np.median(new_dist[valid] / old_dist[valid])) if valid.any() else 1.0
+
+        x, y, w, h = self._box
+        cx, cy = x + w / 2 + shift[0], y + h / 2 + shift[1]
+        w, h = w * scale, h * scale
+        self._box = np.array([cx - w / 2, cy - h / 2, w, h], dtype=np.float32)
+        self._points = new.reshape(-1, 1, 2)
+        self._prev_image = image
+        return True, self._box, confidence
+
+
+class OpenCVTracker:
+    COLOR_TRANSFORM = 'bgr'
+
+    def __init__(self):
+        self._tracker = None
+
+    def create(self):
+        raise NotImplementedError
+
+    def init(self, image, box):
+        self._tracker = self.create()
+        self._tracker.init(image, tuple(int(v) for v in box))
+
+    def update(self, image):
+        ok, box = self._tracker.update(image)
+        return ok, box, 1.0 if ok else 0.0
+
+
+class KCFTracker(OpenCVTracker):
+
+    def create(self):
+        return cv2.TrackerKCF_create()
+
+
+class MOSSETracker(OpenCVTracker):
+    COLOR_TRANSFORM = 'gray'
+
+    def create(self):
+        # Only available in opencv-contrib
+        return cv2.legacy.TrackerMOSSE_create()
+
+
+TRACKER_MAP = {
+    'flow': FlowTracker,
+    'kcf': KCFTracker,
+    'mosse': MOSSETracker,}
+
+
+class TrackedDetector(Detector):
+
+    def __init__(self,
+                 camera,
+                 detector,
+                 rate=-1,
+                 tracker='flow',
+                 keyframe_interval=10,
+                 keyframe_rate=-1,
+                 min_confidence=0.5,
+                 track_frame_size=(320, 240)):
+        # The wrapped detector is only used on keyframes and is never started itself
+        super().__init__(camera, rate, track_frame_size)
+        self.COLOR_TRANSFORM = TRACKER_MAP[tracker].COLOR_TRANSFORM
+        self._detector = detector
+        self._tracker_class = TRACKER_MAP[tracker]
+        self._keyframe_interval = keyframe_interval
+        self._keyframe_rate = keyframe_rate
+        self._last_keyframe_time = 0
+        self._min_confidence = min_confidence
+        self._trackers = []
+        self._scores = None
+        self._since_keyframe = 0
+        self._keyframes = 0
+        self._drift = 0
+
+    def warm_up(self, iterations=2):
+        # The trackers are created per keyframe, only the detector has something to warm up
+        self._detector.warm_up(iterations)
+
+    def get_frame(self):
+        # Keep the full frame, process() preprocesses it for the tracker and on keyframes for the detector
+        return self.next_frame()
+
+    def process(self, frame):
+        image = self.preprocess(frame)
+
+        boxes, confidence = [], 1.0
+        for tracker in self._trackers:
+            ok, box, tracker_confidence = tracker.update(image)
+            confidence = min(confidence, tracker_confidence if ok else 0.0)
+            boxes.append(box)
+
+        if not self._trackers:
+            # Nothing to track, search for faces no faster than the detector rate, every frame without a rate
+            if self._keyframe_rate > 0 and time.time() - self._last_keyframe_time < 1 / self._keyframe_rate:
+                return Detections(), []
+            return self._keyframe(frame, image, boxes)
+
+        if confidence < self._min_confidence or self._since_keyframe >= self._keyframe_interval:
+            return self._keyframe(frame, image, boxes)
+
+        self._since_keyframe += 1
+        return Detections(np.array(boxes, dtype=np.float32) * self._frame_scale(), self._scores), []
+
+    def _keyframe(self, frame, image, tracked_boxes):
+        detections, labels = self._detector.process(self._detector.preprocess(frame))
+        detections = self._detector.update_roi(detections)
+        self._keyframes += 1
+        self._since_keyframe = 0
+        self._last_keyframe_time = time.time()
+
+        # Drift: centre offset between the closest tracked box and the best fresh detection, relative to box width
+        if tracked_boxes and len(detections) > 0:
+            tracked = np.array(tracked_boxes, dtype=np.float32) * self._frame_scale()
+            detected = detections.boxes[detections.best()]
+            offsets = np.hypot(*(tracked[:, :2] + tracked[:, 2:] / 2 - detected[:2] - detected[2:] / 2).T)
+            self._drift = 0.9 * self._drift + 0.1 * offsets.min() / max(1, detected[2])
+
+        self._trackers = []
+        for box in detections.boxes / self._frame_scale():
+            tracker = self._tracker_class()
+            tracker.init(image, box)
+            self._trackers.append(tracker)
+        self._scores = detections.scores
+
+        return detections, labels
+
+    def keyframe_ratio(self):
+        return self._keyframes / max(1, self._processed_frames)
+
+    def drift(self):
+        return self._drift
+
+    def stats(self):
+        return {**super().stats(), 'Keyframes / Drift': f'{self.keyframe_ratio():.2f} / {self.drift():.2f}'}
@@ -1,4 +1,7 @@
+import time
+
 import cv2
+import numpy as np
 
 
 def calculate_middle_xywh(detection):
@@ -27,3 +30,41 @@ def visualise_stats(frame, stats, location=(10, 30), color=(0, 255, 0), thicknes
         location = (location[0], location[1] + 30)
 
     return frame
+
+
+class StatsOverlay:
+    # Stats text rendered into a mask and pasted onto every frame. Latencies change on nearly every frame,
+    # so the stats are only gathered and redrawn every interval seconds, or when the frame size changes
+
+    def __init__(self, location=(10, 30), color=(0, 255, 0), thickness=2, interval=1.0):
+        self._location = location
+        self._color = color
+        self._thickness = thickness
+        self._interval = interval
+        self._render_time = None
+        self._shape = None
+        self._mask = None
+        self._text = None
+        self._bounds = None
+
+    def draw(self, frame, get_stats):
+        now = time.perf_counter()
+        if self._render_time is None or now - self._render_time >= self._interval or frame.shape != self._shape:
+            self._render(frame.shape, get_stats())
+            self._render_time = now
+        top, bottom, left, right = self._bounds
+        cv2.copyTo(self._text, self._mask, frame[top:bottom, left:right])
+        return frame
+
+    def _render(self, shape, stats):
+        canvas = visualise_stats(np.zeros(shape[:2], dtype=np.uint8), stats, self._location, 255, self._thickness)
+        rows, cols = np.nonzero(canvas.any(axis=1))[0], np.nonzero(canvas.any(axis=0))[0]
+        self._bounds = (0, 0, 0, 0) if len(rows) == 0 else (rows[0], rows[-1] + 1, cols[0], cols[-1] + 1)
+        top, bottom, left, right = self._bounds
+        self._mask = (canvas[top:bottom, left:right] > 127).astype(np.uint8)
+        color = np.array(self._color, dtype=np.uint8)
+        if len(shape) == 2:
+            # Grayscale frames get the text in the brightness of the color
+            color = cv2.cvtColor(color[np.newaxis, np.newaxis], cv2.COLOR_BGR2GRAY)[0, 0]
+        self._text = np.full((bottom - top, right - left) + shape[2:], color, dtype=np.uint8)
+        self._shape = shape